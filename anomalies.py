@@ -0,0 +1,98 @@
+"""Detecção de picos de gasto por subcategoria ao longo do histórico.
+
+Monta a matriz meses × subcategorias e compara cada célula com a mediana dos
+meses anteriores (janela móvel), usando o MAD como escala. Todas as células são
+calculadas de uma vez com NumPy, sem uma consulta por subcategoria.
+
+Meses sem lançamentos da subcategoria ficam de fora da comparação (NaN), e não
+como zero: despesas esporádicas ou anuais (13° salário, férias) só são avaliadas
+quando aparecem em ANOMALY_MIN_HISTORY meses da janela.
+"""
+import os
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+ANOMALY_WINDOW = int(os.environ.get('ANOMALY_WINDOW', 12))  # meses anteriores comparados
+ANOMALY_MIN_HISTORY = int(os.environ.get('ANOMALY_MIN_HISTORY', 6))  # meses mínimos na janela
+ANOMALY_THRESHOLD = float(os.environ.get('ANOMALY_THRESHOLD', 3.5))  # score robusto mínimo
+ANOMALY_MIN_AMOUNT = float(os.environ.get('ANOMALY_MIN_AMOUNT', 100.0))  # R$ acima da mediana
+
+# Torna o MAD comparável ao desvio padrão em dados com distribuição normal
+MAD_SCALE = 1.4826
+# Escala mínima (fração da mediana, ou R$ 1): séries constantes têm MAD zero
+MIN_SCALE_RATIO = 0.05
+
+
+def build_matrix(months, rows):
+    """Monta a matriz de valores.
+
+    `months` são os meses importados, em ordem; `rows` são (mês, categoria,
+    subcategoria, total). Retorna (chaves (categoria, subcategoria), matriz
+    meses × chaves). Uma subcategoria sem lançamentos em um mês importado vale NaN.
+    """
+    month_index = {month: position for position, month in enumerate(months)}
+    rows = [row for row in rows if row[0] in month_index]
+    keys = list(dict.fromkeys((row[1], row[2]) for row in rows))
+    key_index = {key: position for position, key in enumerate(keys)}
+    matrix = np.full((len(months), len(keys)), np.nan)
+    if rows:
+        month_positions = np.fromiter((month_index[row[0]] for row in rows), dtype=np.intp, count=len(rows))
+        key_positions = np.fromiter((key_index[(row[1], row[2])] for row in rows), dtype=np.intp, count=len(rows))
+        values = np.fromiter((row[3] for row in rows), dtype=float, count=len(rows))
+        matrix[month_positions, key_positions] = 0.0
+        np.add.at(matrix, (month_positions, key_positions), values)
+    return keys, matrix
+
+
+def _median_last_axis(values, counts):
+    """Mediana no último eixo ignorando NaN; `counts` é o número de valores válidos de cada fatia.
+
+    Ordena uma vez (NaN vai para o fim) e pega os elementos do meio, bem mais
+    rápido que np.nanmedian em arrays 3D com NaN.
+    """
+    ordered = np.sort(values, axis=-1)
+    safe_counts = np.maximum(counts, 1)
+    low = np.take_along_axis(ordered, ((safe_counts - 1) // 2)[..., None], axis=-1)[..., 0]
+    high = np.take_along_axis(ordered, (safe_counts // 2)[..., None], axis=-1)[..., 0]
+    return np.where(counts > 0, (low + high) / 2, np.nan)
+
+
+def find_spikes(matrix, window=ANOMALY_WINDOW, min_history=ANOMALY_MIN_HISTORY,
+                threshold=ANOMALY_THRESHOLD, min_amount=ANOMALY_MIN_AMOUNT):
+    """Marca as células muito acima da mediana dos `window` meses anteriores.
+
+    Retorna (índices dos meses, índices das subcategorias, medianas, scores) das
+    células marcadas, onde score = (valor - mediana) / (MAD * 1,4826). Células
+    NaN (sem lançamentos) não entram na janela nem são marcadas; a subcategoria
+    precisa ter aparecido em `min_history` dos meses da janela.
+    """
+    n_months, n_keys = matrix.shape
+    if n_months == 0 or n_keys == 0:
+        empty = np.array([], dtype=np.intp)
+        return empty, empty, np.array([]), np.array([])
+
+    # Linha m da janela = os `window` meses anteriores a m (NaN antes do início do histórico)
+    padded = np.vstack([np.full((window, n_keys), np.nan), matrix])
+    history = sliding_window_view(padded, window, axis=0)[:n_months]
+    counts = np.count_nonzero(~np.isnan(history), axis=2)
+    enough_history = counts >= min_history
+
+    median = _median_last_axis(history, counts)
+    mad = _median_last_axis(np.abs(history - median[..., None]), counts)
+    scale = np.maximum(mad * MAD_SCALE, np.maximum(np.abs(median) * MIN_SCALE_RATIO, 1.0))
+
+    excess = matrix - median
+    with np.errstate(invalid='ignore'):
+        score = excess / scale
+        flags = enough_history & ~np.isnan(matrix) & (score >= threshold) & (excess >= min_amount)
+    month_positions, key_positions = np.nonzero(flags)
+    return month_positions, key_positions, median[flags], score[flags]
+
+
+def detect(months, rows, **params):
+    """Picos de gasto de todo o histórico: [(mês, categoria, subcategoria, valor, mediana, score)]."""
+    keys, matrix = build_matrix(months, rows)
+    month_positions, key_positions, baselines, scores = find_spikes(matrix, **params)
+    return [(months[m], *keys[k], float(matrix[m, k]), float(baseline), float(score))
+            for m, k, baseline, score in zip(month_positions, key_positions, baselines, scores)]
@@ -1,224 +1,443 @@
-from flask import Flask, request, render_template, redirect, url_for, flash
-import pandas as pd
-from datetime import datetime
+from flask import (Flask, request, render_template, redirect, url_for, flash, jsonify, g, abort,
+                   stream_with_context, before_render_template, template_rendered)
 import os
+import contextvars
 import re
+import glob
+import gzip
+import hashlib
+import io
+import multiprocessing
+import shutil
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from werkzeug.utils import secure_filename
 import database as db  # Importa nosso novo módulo de banco de dados
-from collections import defaultdict
+import exports
+import metrics
+import tenants
+from excel_parser import parse_excel  # leve: openpyxl/pandas só carregam ao ler uma planilha
 
 app = Flask(__name__)
+# Escritório da requisição pelo subdomínio ou pelo prefixo /t/<escritorio> (ver tenants.py)
+app.wsgi_app = tenants.TenantMiddleware(app.wsgi_app)
 app.secret_key = 'uma-chave-secreta-muito-forte' # Troque por uma chave segura
-app.config['UPLOAD_FOLDER'] = 'Uploads'
-app.config['ALLOWED_EXTENSIONS'] = {'xlsx'}
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+app.config['ALLOWED_EXTENSIONS'] = {'xlsx', 'zip'}
+app.config['INGEST_WORKERS'] = int(os.environ.get('INGEST_WORKERS', 2))
+app.config['BATCH_PARSE_WORKERS'] = int(os.environ.get('BATCH_PARSE_WORKERS', os.cpu_count() or 1))
+# Os processos do lote não nascem por fork do worker: ele tem threads (gthread, jobs)
+# e um fork poderia herdar travas tomadas por elas (métricas, pool de conexões, cache)
+BATCH_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+# Envios são lidos em memória; acima do limite de spool vão para um arquivo temporário
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', 32)) * 1024 * 1024
+app.config['UPLOAD_SPOOL_THRESHOLD'] = int(os.environ.get('UPLOAD_SPOOL_THRESHOLD_MB', 8)) * 1024 * 1024
+UPLOAD_SPOOL_PREFIX = 'contajur-upload-'
+# Limite do conteúdo descompactado de cada .zip (soma das planilhas), contra zip bombs
+app.config['MAX_UNZIPPED_SIZE'] = int(os.environ.get('MAX_UNZIPPED_MB', 128)) * 1024 * 1024
+# Cópia opcional dos arquivos importados, nomeados pelo SHA-256 (desligada se vazio)
+app.config['UPLOAD_ARCHIVE_DIR'] = os.environ.get('UPLOAD_ARCHIVE_DIR') or None
+app.config['UPLOAD_ARCHIVE_MAX_FILES'] = int(os.environ.get('UPLOAD_ARCHIVE_MAX_FILES', 200))
+
+# Fila de importação: o processamento das planilhas roda fora do ciclo da requisição
+ingest_executor = ThreadPoolExecutor(max_workers=app.config['INGEST_WORKERS'],
+                                     thread_name_prefix='ingest')
+
+# Compressão gzip das respostas (HTML e JSON)
+GZIP_MIN_SIZE = 500
+GZIP_MIMETYPES = {'text/html', 'application/json'}
+GZIP_ETAG_SUFFIX = '-gzip'
+
+# Devolve a conexão da thread ao final de cada requisição
+app.teardown_appcontext(db.close_db_connection)
+
+def submit_job(fn, *args):
+    """Enfileira um job de importação no escritório atual; a conexão da thread é devolvida ao final."""
+    # Arquivos de jobs dados como abandonados (worker reiniciado) que nunca chegaram ao release_source
+    for path in db.take_abandoned_spool_files():
+        release_source(path)
+    context = contextvars.copy_context()  # leva database.current_tenant para a thread do job
+    def run():
+        try:
+            context.run(fn, *args)
+        finally:
+            db.close_db_connection()
+    return ingest_executor.submit(run)
 
 # --- INICIALIZAÇÃO DO BANCO DE DADOS ---
-# Esta função garante que o banco de dados seja criado assim que o app iniciar.
-with app.app_context():
-    db.init_db()
+# As migrações não rodam na importação do módulo: no gunicorn, o banco principal
+# é migrado uma vez no processo mestre (hook on_starting do gunicorn.conf.py);
+# nos demais casos, e nos bancos dos escritórios, na primeira conexão do processo
+# a cada banco (ou antes, com `python database.py migrate`).
+
+@app.context_processor
+def inject_tenant():
+    return {'tenant': db.current_tenant.get(), 'multi_tenant': bool(db.TENANT_DATA_DIR)}
+
+# --- MÉTRICAS ---
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+def _record_template_start(sender, template, context, **extra):
+    g.template_start = time.perf_counter()
+
+def _record_template_render(sender, template, context, **extra):
+    start = g.pop('template_start', None)
+    if start is not None:
+        metrics.observe('contajur_template_render_duration_seconds', time.perf_counter() - start,
+                        template=template.name or '<string>')
+
+before_render_template.connect(_record_template_start, app)
+template_rendered.connect(_record_template_render, app)
+
+def parse_excel_in_worker(source, category_map):
+    """parse_excel para o ProcessPoolExecutor: grava as métricas antes de devolver o resultado."""
+    try:
+        return parse_excel(open_source(source), category_map)
+    finally:
+        metrics.flush()
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
-def process_excel(file_path):
+def is_workbook(filename):
+    return filename.lower().endswith('.xlsx')
+
+class UploadTooLarge(Exception):
+    """O conteúdo lido de um envio passou do limite permitido."""
+
+def read_upload(stream, limit=None):
+    """Lê um arquivo enviado e calcula seu SHA-256: retorna (origem, sha256).
+
+    Até UPLOAD_SPOOL_THRESHOLD a origem são os próprios bytes; acima disso, o
+    caminho de um arquivo temporário exclusivo, que deve ser liberado com
+    release_source() quando o processamento terminar. Com `limit`, a leitura
+    para com UploadTooLarge assim que passar de `limit` bytes.
+    """
+    threshold = app.config['UPLOAD_SPOOL_THRESHOLD']
+    digest = hashlib.sha256()
+    head = stream.read(threshold + 1 if limit is None else min(threshold, limit) + 1)
+    if limit is not None and len(head) > limit:
+        raise UploadTooLarge()
+    digest.update(head)
+    if len(head) <= threshold:
+        return head, digest.hexdigest()
+    spool = tempfile.NamedTemporaryFile(prefix=UPLOAD_SPOOL_PREFIX, suffix='.xlsx', delete=False)
+    size = len(head)
     try:
-        # Lê o cabeçalho para extrair o mês
-        df_header = pd.read_excel(file_path, sheet_name='Página 1', nrows=1, header=None)
-        first_row = df_header.iloc[0, 0]
-        date_match = re.search(r'(\d{2}/\d{2}/\d{4})\s*à\s*(\d{2}/\d{2}/\d{4})', str(first_row))
-        month = datetime.strptime(date_match.group(1), '%d/%m/%Y').strftime('%Y-%m') if date_match else datetime.now().strftime('%Y-%m')
-        
-        # Lê o Excel SEM pular linhas
-        df = pd.read_excel(file_path, sheet_name='Página 1', header=None)
-        
-        # Função auxiliar para converter valores BR para float
-        def convert_br_to_float(value):
-            """Converte valores no formato brasileiro (1.234,56) para float"""
-            if pd.isna(value):
-                return 0.0
-            if isinstance(value, (int, float)):
-                return float(value)
-            value_str = str(value).strip()
-            value_str = value_str.replace('.', '').replace(',', '.')
-            try:
-                return float(value_str)
-            except:
-                return 0.0
-        
-        # Procura por "Receitas:" e "Despesas:" na coluna 10 (índice 10)
-        coluna_busca = df.iloc[:, 10].astype(str).str.strip()
-        
-        # Encontra os índices das linhas que contêm "Receitas:" e "Despesas:"
-        idx_receitas = coluna_busca[coluna_busca == 'Receitas:'].index
-        idx_despesas = coluna_busca[coluna_busca == 'Despesas:'].index
-        
-        if len(idx_receitas) == 0 or len(idx_despesas) == 0:
-            raise ValueError("Não foi possível encontrar 'Receitas:' ou 'Despesas:' na coluna K do arquivo.")
-        
-        # Pega a primeira ocorrência (caso haja mais de uma)
-        linha_receitas = idx_receitas[0]
-        linha_despesas = idx_despesas[0]
-        
-        # Pega os valores da coluna 11 (índice 11 = coluna L)
-        total_revenue = convert_br_to_float(df.iloc[linha_receitas, 11])
-        total_expenses_raw = convert_br_to_float(df.iloc[linha_despesas, 11])
-        
-        # Agora lê novamente COM cabeçalho para processar despesas detalhadas
-        df_with_header = pd.read_excel(file_path, sheet_name='Página 1', skiprows=1)
-        df_with_header['Descrição'] = df_with_header['Descrição'].astype(str)
-        
-        # Encontra a coluna 'Total' para processar despesas detalhadas
-        if 'Total' in df_with_header.columns:
-            total_col = 'Total'
+        with spool:
+            spool.write(head)
+            for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+                size += len(chunk)
+                if limit is not None and size > limit:
+                    raise UploadTooLarge()
+                digest.update(chunk)
+                spool.write(chunk)
+    except BaseException:
+        release_source(spool.name)
+        raise
+    return spool.name, digest.hexdigest()
+
+def open_source(source):
+    """Arquivo aceito por parse_excel: BytesIO para envios em memória, caminho para os em disco."""
+    return io.BytesIO(source) if isinstance(source, bytes) else source
+
+def release_source(source):
+    """Remove o arquivo temporário de um envio grande (envios em memória não ocupam disco)."""
+    if isinstance(source, str):
+        try:
+            os.remove(source)
+        except FileNotFoundError:
+            pass
+
+def spool_paths(sources):
+    """Arquivos temporários entre as origens (envios em memória não têm)."""
+    return [source for source in sources if isinstance(source, str)]
+
+def remove_all_spools():
+    """Apaga todos os arquivos temporários de envio (início do servidor, sem jobs rodando)."""
+    for path in glob.glob(os.path.join(tempfile.gettempdir(), UPLOAD_SPOOL_PREFIX + '*')):
+        release_source(path)
+
+def archive_upload(source, sha256):
+    """Guarda uma cópia do arquivo importado em UPLOAD_ARCHIVE_DIR, mantendo só os mais recentes."""
+    archive_dir = app.config['UPLOAD_ARCHIVE_DIR']
+    if not archive_dir:
+        return
+    try:
+        os.makedirs(archive_dir, exist_ok=True)
+        path = os.path.join(archive_dir, f'{sha256}.xlsx')
+        if os.path.exists(path):
+            os.utime(path)  # Reenvio: conta como recente para a retenção
         else:
-            numeric_cols = df_with_header.select_dtypes(include=['number']).columns
-            total_col = numeric_cols[-1] if len(numeric_cols) > 0 else df_with_header.columns[-1]
-        
+            temp_path = f'{path}.{os.getpid()}.tmp'
+            if isinstance(source, bytes):
+                with open(temp_path, 'wb') as target:
+                    target.write(source)
+            else:
+                shutil.copyfile(source, temp_path)
+            os.replace(temp_path, path)
+        archived = sorted((entry for entry in os.scandir(archive_dir) if entry.name.endswith('.xlsx')),
+                          key=lambda entry: entry.stat().st_mtime, reverse=True)
+        for entry in archived[app.config['UPLOAD_ARCHIVE_MAX_FILES']:]:
+            os.remove(entry.path)
+    except OSError:
+        # O arquivo morto é opcional: uma falha nele não invalida a importação
+        app.logger.exception("Falha ao arquivar o envio %s", sha256)
+
+def describe_changes(changes):
+    return (f"Despesas: {changes['inserted']} novas, {changes['updated']} alteradas, "
+            f"{changes['deleted']} removidas, {changes['unchanged']} sem alteração.")
+
+def process_excel(source, upload=None):
+    """Lê a planilha com a categorização da tabela `categories` e grava o mês.
+
+    `source` é um caminho ou os bytes do arquivo. O resultado de parse_excel
+    volta com a chave 'changes' (resumo da diferença aplicada).
+    """
+    parsed = parse_excel(open_source(source), db.get_category_map())
+    parsed['changes'] = db.save_processed_excel_data(parsed['month'], parsed['totals_data'],
+                                                     parsed['expenses_data'], upload=upload)
+    return parsed
+
+def run_ingest_job(job_id, source, filename, sha256):
+    """Executa um job de importação (chamado pelas threads da fila)."""
+    try:
+        if not db.update_ingest_job(job_id, 'running'):
+            return  # dado como abandonado enquanto esperava na fila
+        parsed = process_excel(source, upload={'sha256': sha256, 'filename': filename})
+        archive_upload(source, sha256)
     except Exception as e:
-        raise ValueError(f"Erro ao ler os totais de Receita/Despesa do Excel. Detalhe: {e}")
-
-    # Cálculo de Honorários
-    desc_normalized = df_with_header['Descrição'].str.strip().str.lower().str.normalize('NFKD').str.encode('ascii', errors='ignore').str.decode('utf-8')
-    mask_honorarios = desc_normalized.str.startswith('honorario', na=False)
-    honorarios_values = df_with_header.loc[mask_honorarios, total_col].apply(convert_br_to_float)
-    total_fees = float(honorarios_values.sum())
-
-    # Cálculos de lucro (SEM retiradas)
-    total_expenses = total_expenses_raw
-    profit_before_withdrawals = total_revenue - total_expenses
-    net_profit = profit_before_withdrawals
-    profit_margin = (net_profit / total_revenue * 100) if total_revenue > 0 else 0
-
-    # Distribuição inicial
-    initial_profit_share = profit_before_withdrawals / 4.0
-    shares = {
-        'Lucas': initial_profit_share,
-        'Thiago': initial_profit_share,
-        'Ronaldo': initial_profit_share,
-        'Reserva': initial_profit_share
-    }
-
-    totals_data = {
-        "month": month,
-        "total_revenue": total_revenue,
-        "total_expenses": total_expenses,
-        "total_fees": total_fees,
-        "net_profit": net_profit,
-        "profit_margin": profit_margin,
-        "share_lucas": shares['Lucas'],
-        "share_thiago": shares['Thiago'],
-        "share_ronaldo": shares['Ronaldo'],
-        "share_reserva": shares['Reserva']
-    }
-    
-    # Categorização de despesas com GRUPOS
-    expenses_data = []
-    categories = {
-        'Despesas com Pessoal': [
-            'Salários',
-            '13° Salário',
-            'Férias',
-            'Vale transporte',
-            'Vale alimentação',
-            'Plano de Saude',
-            'Plano Odontologico',
-            'Aniversário colaboradores',
-            'Seguro de vida',
-            'Feira, Mercado e outros',
-            'SST',
-            'Cursos e Palestras'
-        ],
-        'Impostos e Encargos': [
-            'DAS - CONTAJUR',
-            'FGTS - CONTAJUR',
-            'DARF Previdenciário - Contajur'
-        ],
-        'Despesas de Escritório': [
-            'Luz',
-            'Telefonia',
-            'Internet',
-            'Aluguel',
-            'Materiais de limpeza',
-            'Uniformes',
-            'Material de escritório',
-            'Material de uso e consumo',
-            'Segurança'
-        ],
-        'Mensalidades e Serviços': [
-            'Mensalidade de Sistema',
-            'Mensalidade T.I.',
-            'Mensalidade Marketing Digital',
-            'Mensalidade Revista Tecnica',
-            'Mensalidade Aluguel de Impressora',
-            'Mensalidade Associal Comercial',
-            'Mensalidade Manutenção Web',
-            'Implantação Sistema',
-            'Mensalidade Personal',
-            'Mensalidade Rede Cidada'
-        ],
-        'Manutenção e Investimentos': [
-            'Manutenção Contajur (pintura, reforma, etc.)',
-            'Aquisição imóvel/construção',
-            'Combustivel e Manutençao Motos'
-        ],
-        'Reembolsos a Clientes': [
-            'DAS - Reembolso Imposto Federal - Cliente',
-            'Reembolso Imposto Estadual - Cliente',
-            'Reembolso Imposto Estadual ICMS - Cliente',
-            'GPS Autonomo - Reembolso Trabalhista- Cliente',
-            'Abertura,baixa e alteração JUCEMG - Cliente',
-            'Reembolso Certificado Digital',
-            'FGTS - Reembolso trabalhista - Cliente',
-            'Esocial - Reembolso trabalhista - Cliente',
-            'Contrib Sindical - Reembolso trabalhista - cliente',
-            'DARF - Retenção NF - Cliente',
-            'ISSQN - Cliente',
-            'DARF Previdenciário - Cliente',
-            'Carnê Leão - cliente',
-            'DAS Parcelamento - Reembolso de cliente'
-        ],
-        'Outras Despesas': [
-            'Outras despesas',
-            'Confraternização e Brindes fim de ano',
-            'Multa e Juros',
-            'Tarifa Bancaria'
-        ]
-    }
-    
-    for category, subcategories in categories.items():
-        rows = df_with_header[df_with_header['Descrição'].str.strip().isin(subcategories)]
-        for _, row in rows.iterrows():
-            amount = convert_br_to_float(row[total_col])
-            if amount != 0:
-                expenses_data.append((month, category, row['Descrição'], float(amount)))
+        if not isinstance(e, ValueError):
+            app.logger.exception("Falha no job de importação %s", job_id)
+        db.update_ingest_job(job_id, 'failed', message=str(e))
+    else:
+        processed_month = parsed['month']
+        db.update_ingest_job(job_id, 'done', month=processed_month,
+                             message=f'Relatório do mês {processed_month} processado com sucesso! '
+                                     f'{describe_changes(parsed["changes"])}',
+                             report=[{'file': filename, 'status': 'done', 'month': processed_month,
+                                      'changes': parsed['changes'], 'unmapped': parsed['unmapped']}])
+    finally:
+        release_source(source)
 
-    # Sem retiradas do Excel
-    withdrawals_data = []
+def run_batch_job(job_id, files):
+    """Processa um lote de planilhas em paralelo e grava tudo em uma única transação.
 
-    db.save_processed_excel_data(month, totals_data, expenses_data, withdrawals_data)
-    
-    return month
+    `files` é uma lista de (nome do arquivo, origem, sha256). Arquivos idênticos
+    a um já importado são ignorados sem leitura. A falha de um arquivo não
+    impede a importação dos demais; o resultado de cada um vai para o
+    relatório do job.
+    """
+    report = []
+    parsed_batch = []
+    done_items = []
+    try:
+        if not db.update_ingest_job(job_id, 'running'):
+            return  # dado como abandonado enquanto esperava na fila
+        category_map = db.get_category_map()
+        to_parse = []
+        for name, source, sha256 in files:
+            previous = db.find_processed_upload(sha256)
+            if previous:
+                report.append({'file': name, 'status': 'skipped', 'month': previous['month']})
+            else:
+                to_parse.append((name, source, sha256))
+        max_workers = max(1, min(len(to_parse), app.config['BATCH_PARSE_WORKERS']))
+        with ProcessPoolExecutor(max_workers=max_workers,
+                                 mp_context=multiprocessing.get_context(BATCH_START_METHOD)) as pool:
+            futures = [(name, source, sha256, pool.submit(parse_excel_in_worker, source, category_map))
+                       for name, source, sha256 in to_parse]
+            archived = []
+            for name, source, sha256, future in futures:
+                try:
+                    parsed = future.result()
+                except Exception as e:
+                    report.append({'file': name, 'status': 'failed', 'message': str(e)})
+                else:
+                    parsed['upload'] = {'sha256': sha256, 'filename': name}
+                    parsed_batch.append(parsed)
+                    archived.append((source, sha256))
+                    done_items.append({'file': name, 'status': 'done', 'month': parsed['month'],
+                                       'unmapped': parsed['unmapped']})
+                    report.append(done_items[-1])
+                # Sinal de vida: um lote longo não deve ser dado como abandonado
+                if not db.touch_ingest_job(job_id):
+                    app.logger.warning("Lote de importação %s dado como abandonado; nada foi gravado", job_id)
+                    return
+        for item, changes in zip(done_items, db.save_processed_excel_batch(parsed_batch)):
+            item['changes'] = changes
+        for source, sha256 in archived:
+            archive_upload(source, sha256)
+    except Exception as e:
+        app.logger.exception("Falha no lote de importação %s", job_id)
+        db.update_ingest_job(job_id, 'failed', message=f'Erro ao gravar o lote: {e}', report=report)
+        return
+    finally:
+        for _, source, _ in files:
+            release_source(source)
+
+    months = sorted(item['month'] for item in report if item['status'] != 'failed')
+    skipped = sum(1 for item in report if item['status'] == 'skipped')
+    db.update_ingest_job(job_id, 'done' if months else 'failed',
+                         month=months[-1] if months else None,
+                         message=f'Lote processado: {len(parsed_batch)} de {len(files)} arquivos importados'
+                                 f' ({skipped} idênticos a envios anteriores).',
+                         report=report)
+
+def source_size(source):
+    return len(source) if isinstance(source, bytes) else os.path.getsize(source)
+
+def read_batch_files(files):
+    """Lê os arquivos enviados (expandindo os .zip) e retorna [(nome, origem, sha256)].
+
+    O conteúdo descompactado de cada .zip é limitado a MAX_UNZIPPED_SIZE: pelo
+    tamanho declarado de cada planilha antes de ler e pelos bytes de fato lidos.
+    """
+    saved = []
+    try:
+        for file in files:
+            if is_workbook(file.filename):
+                saved.append((secure_filename(file.filename), *read_upload(file.stream)))
+                continue
+            remaining = app.config['MAX_UNZIPPED_SIZE']
+            with zipfile.ZipFile(file.stream) as archive:
+                for info in archive.infolist():
+                    name = secure_filename(os.path.basename(info.filename))
+                    if info.is_dir() or not is_workbook(name) or info.filename.startswith('__MACOSX/'):
+                        continue
+                    if info.file_size > remaining:
+                        raise UploadTooLarge()
+                    with archive.open(info) as member:
+                        source, sha256 = read_upload(member, limit=remaining)
+                    saved.append((name, source, sha256))
+                    remaining -= source_size(source)
+    except BaseException:
+        for _, source, _ in saved:
+            release_source(source)
+        raise
+    return saved
+
+@app.after_request
+def record_request_metrics(response):
+    """Conta a requisição e registra sua duração (registrado antes do gzip, roda por último)."""
+    start = g.pop('request_start', None)
+    route = request.url_rule.rule if request.url_rule else '<unmatched>'
+    metrics.inc('contajur_http_requests_total', method=request.method, route=route,
+                status=str(response.status_code))
+    if start is not None:
+        metrics.observe('contajur_http_request_duration_seconds', time.perf_counter() - start,
+                        method=request.method, route=route)
+    return response
+
+@app.after_request
+def compress_response(response):
+    """Comprime com gzip as respostas grandes quando o cliente aceita."""
+    if response.mimetype not in GZIP_MIMETYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    if (response.status_code != 200 or response.is_streamed or 'Content-Encoding' in response.headers
+            or 'gzip' not in request.accept_encodings):
+        return response
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    # A representação comprimida tem bytes diferentes, então recebe um ETag forte próprio
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(etag + GZIP_ETAG_SUFFIX, weak)
+    return response
+
+def conditional_json(etag, build):
+    """Responde 304 se o If-None-Match bater com o ETag; senão gera o JSON com build()."""
+    gzip_etag = etag + GZIP_ETAG_SUFFIX
+    if request.if_none_match.contains(etag) or request.if_none_match.contains(gzip_etag):
+        response = app.response_class(status=304, mimetype='application/json')
+        response.set_etag(gzip_etag if request.if_none_match.contains(gzip_etag) else etag)
+    else:
+        response = jsonify(build())
+        response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def describe_unmapped(report_item, limit=5):
+    """Mensagem com as descrições do Excel que não têm categoria cadastrada."""
+    unmapped = report_item['unmapped']
+    names = ', '.join(f"{item['subcategory']} (R$ {item['amount']:.2f})" for item in unmapped[:limit])
+    if len(unmapped) > limit:
+        names += f' e mais {len(unmapped) - limit}'
+    return (f"{report_item['file']} ({report_item['month']}): {len(unmapped)} descrição(ões) sem "
+            f"categoria não foram importadas: {names}")
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    flash(f"Envio maior que o limite de {app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)} MB.", 'error')
+    return redirect(url_for('dashboard'))
 
 @app.route('/', methods=['GET', 'POST'])
 def dashboard():
     error = None
     if request.method == 'POST' and 'file' in request.files:
-        file = request.files['file']
-        if file.filename == '':
+        files = [f for f in request.files.getlist('file') if f.filename]
+        if not files:
             error = 'Nenhum arquivo selecionado'
-        elif file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(file_path)
-            try:
-                processed_month = process_excel(file_path)
-                flash(f'Relatório do mês {processed_month} processado com sucesso!', 'success')
-                return redirect(url_for('dashboard', month=processed_month))
-            except ValueError as e:
-                error = str(e)
+        elif not all(allowed_file(f.filename) for f in files):
+            error = 'Extensão de arquivo não permitida. Use .xlsx ou .zip'
+        elif len(files) == 1 and is_workbook(files[0].filename):
+            filename = secure_filename(files[0].filename)
+            source, sha256 = read_upload(files[0].stream)
+            previous = db.find_processed_upload(sha256)
+            if previous:
+                # Reenvio idêntico: nada a ler nem a gravar
+                release_source(source)
+                flash(f"Arquivo idêntico ao já importado para o mês {previous['month']}; "
+                      f"nenhum dado foi alterado.", 'success')
+                return redirect(url_for('dashboard', month=previous['month']))
+            job_id = db.create_ingest_job(filename, spool_files=spool_paths([source]))
+            submit_job(run_ingest_job, job_id, source, filename, sha256)
+            return redirect(url_for('dashboard', job=job_id))
         else:
-            error = 'Extensão de arquivo não permitida. Use .xlsx'
+            filenames = ', '.join(secure_filename(f.filename) for f in files)
+            try:
+                saved = read_batch_files(files)
+            except zipfile.BadZipFile:
+                saved = None
+                error = 'Arquivo .zip inválido.'
+            except UploadTooLarge:
+                saved = None
+                error = (f"O conteúdo descompactado do .zip passa do limite de "
+                         f"{app.config['MAX_UNZIPPED_SIZE'] // (1024 * 1024)} MB.")
+            if saved:
+                job_id = db.create_ingest_job(filenames, spool_files=spool_paths(source for _, source, _ in saved))
+                submit_job(run_batch_job, job_id, saved)
+                return redirect(url_for('dashboard', job=job_id))
+            error = error or 'Nenhuma planilha .xlsx encontrada no envio.'
+            db.update_ingest_job(db.create_ingest_job(filenames), 'failed', message=error)
+
+    job = db.get_ingest_job(request.args['job']) if 'job' in request.args else None
+    if job and job['status'] in ('done', 'failed') and 'month' not in request.args:
+        # Relatório por arquivo (envios em lote) e descrições sem categoria
+        report = job['report'] or []
+        for item in report:
+            if item['status'] == 'skipped':
+                flash(f"{item['file']}: idêntico ao já importado para o mês {item['month']}.", 'success')
+                continue
+            if item['status'] != 'done':
+                flash(f"{item['file']}: {item['message']}", 'error')
+                continue
+            if len(report) > 1:
+                flash(f"{item['file']}: mês {item['month']} importado. {describe_changes(item['changes'])}",
+                      'success')
+            if item.get('unmapped'):
+                flash(describe_unmapped(item), 'error')
+        if job['status'] == 'done':
+            flash(job['message'], 'success')
+            return redirect(url_for('dashboard', month=job['month']))
+        error = job['message']
 
     all_months = db.get_available_months()
     selected_month = request.args.get('month', all_months[0] if all_months else None)
@@ -229,27 +448,186 @@ def dashboard():
                            months=all_months, 
                            selected_month=selected_month, 
                            error=error,
+                           job=job,
                            **dashboard_data)
 
+MONTH_PATTERN = re.compile(r'\d{4}-(0[1-9]|1[0-2])')
+
+def period_args():
+    """Período pedido em ?start=&end= (AAAA-MM, ambos opcionais); ValueError se algum for inválido."""
+    start, end = request.args.get('start') or None, request.args.get('end') or None
+    for month in (start, end):
+        if month is not None and not MONTH_PATTERN.fullmatch(month):
+            raise ValueError(f'Mês inválido: "{month}". Use o formato AAAA-MM.')
+    return start, end
+
+@app.route('/api/trends')
+def api_trends():
+    try:
+        start, end = period_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    version, = db.get_data_versions([db.ALL_MONTHS_SCOPE])
+    return conditional_json(f'trends-{start}-{end}-{version}', lambda: db.get_trend_data(start, end))
+
+@app.route('/api/months')
+def api_months():
+    version, = db.get_data_versions([db.ALL_MONTHS_SCOPE])
+    return conditional_json(f'months-{version}', lambda: {'months': db.get_available_months()})
+
+@app.route('/api/dashboard/<string:month>')
+def api_dashboard(month):
+    version, = db.get_data_versions([month])
+    if month not in db.get_available_months():
+        return jsonify({'error': f'Mês {month} não encontrado.'}), 404
+    return conditional_json(f'dashboard-{month}-{version}', lambda: db.get_dashboard_data(month))
+
+@app.route('/api/compare')
+def api_compare():
+    selected_months = sorted(set(request.args.getlist('month')))
+    if not selected_months:
+        return jsonify({'error': 'Informe ao menos um mês (?month=AAAA-MM).'}), 400
+    versions = db.get_data_versions(selected_months)
+    digest = hashlib.sha256(repr((selected_months, versions)).encode()).hexdigest()[:32]
+
+    def build():
+        totals_comparison, category_comparison = db.get_compare_data(selected_months)
+        return {'selected_months': selected_months,
+                'totals_comparison': totals_comparison,
+                'category_comparison': category_comparison}
+    return conditional_json(f'compare-{digest}', build)
+
+def search_args():
+    """Parâmetros da busca: ?q=texto&page=N&per_page=N."""
+    return (request.args.get('q', '').strip(),
+            request.args.get('page', 1, type=int),
+            request.args.get('per_page', db.SEARCH_PER_PAGE, type=int))
+
+@app.route('/api/search')
+def api_search():
+    text, page, per_page = search_args()
+    if not text:
+        return jsonify({'error': 'Informe o texto da busca (?q=...).'}), 400
+    version, = db.get_data_versions([db.ALL_MONTHS_SCOPE])
+    digest = hashlib.sha256(repr((text, page, per_page, version)).encode()).hexdigest()[:32]
+    return conditional_json(f'search-{digest}', lambda: db.search_expenses(text, page, per_page))
+
+@app.route('/api/categories', methods=['GET', 'POST'])
+def api_categories():
+    if request.method == 'POST':
+        payload = request.get_json(silent=True) or {}
+        subcategory = (payload.get('subcategory') or '').strip()
+        category = (payload.get('category') or '').strip()
+        if not subcategory or not category:
+            return jsonify({'error': "Informe 'subcategory' e 'category'."}), 400
+        db.set_category(subcategory, category)
+    return jsonify(db.get_category_map())
+
+@app.route('/api/partners', methods=['GET', 'POST'])
+def api_partners():
+    if request.method == 'POST':
+        payload = request.get_json(silent=True) or {}
+        name = (payload.get('name') or '').strip()
+        if not name or 'share' not in payload:
+            return jsonify({'error': "Informe 'name' e 'share'."}), 400
+        try:
+            db.save_partner(name, float(payload['share']), bool(payload.get('active', True)))
+        except (ValueError, TypeError) as e:
+            return jsonify({'error': str(e)}), 400
+    return jsonify(db.get_partners())
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache_stats')
+def cache_stats():
+    return jsonify(db.result_cache.stats())
+
+@app.route('/jobs/<string:job_id>')
+def job_status(job_id):
+    job = db.get_ingest_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job não encontrado.'}), 404
+    return jsonify(job)
+
+# Valor com ponto no formato brasileiro: o ponto só separa grupos de três dígitos
+BRAZILIAN_THOUSANDS = re.compile(r'-?\d{1,3}(\.\d{3})+(,\d+)?')
+
+def parse_amount(text, brazilian=False):
+    """Converte um valor digitado em float.
+
+    Com `brazilian` (lançamento em lote), a vírgula é decimal e o ponto só é
+    aceito como separador de milhar: "1.500" vale 1500, e "150.00" é recusado.
+    Sem ele, aceita também "1234.56" (campo numérico do formulário, API), mas
+    recusa "1.500" e afins. Valores ambíguos nunca são adivinhados.
+    """
+    if isinstance(text, (int, float)) and not isinstance(text, bool):
+        return float(text)
+    text = str(text).strip().replace('R$', '').strip()
+    if brazilian or ',' in text:
+        if '.' in text and not BRAZILIAN_THOUSANDS.fullmatch(text):
+            raise ValueError(f'Valor ambíguo: "{text}". Use vírgula nos centavos (ex.: 1.500,00).')
+        text = text.replace('.', '').replace(',', '.')
+    elif '.' in text and len(text.rpartition('.')[2]) > 2:
+        raise ValueError(f'Valor ambíguo: "{text}". Use vírgula nos centavos (ex.: 1.500,00).')
+    try:
+        return float(text)
+    except ValueError:
+        raise ValueError('O valor da retirada deve ser um número.')
+
+def parse_withdrawal_lines(month, text):
+    """Lê o lançamento em lote do formulário: uma retirada "Sócio; valor" por linha."""
+    entries = []
+    for position, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        partner, separator, amount = line.partition(';')
+        if not separator:
+            raise ValueError(f'Linha {position}: use o formato "Sócio; valor".')
+        try:
+            entries.append((month, partner.strip(), parse_amount(amount, brazilian=True)))
+        except ValueError as e:
+            raise ValueError(f'Linha {position}: {e}')
+    return entries
+
 @app.route('/add_withdrawal', methods=['POST'])
 def add_withdrawal():
     month = request.form.get('month')
-    person = request.form.get('person')
-    amount_str = request.form.get('amount')
     try:
-        amount = float(amount_str)
-        db.add_manual_withdrawal(month, person, amount)
-        flash(f'Retirada de {person} adicionada com sucesso!', 'success')
-    except (ValueError, TypeError):
-        flash('Erro: O valor da retirada deve ser um número.', 'error')
+        if request.form.get('entries', '').strip():
+            count = db.add_withdrawals(parse_withdrawal_lines(month, request.form['entries']))
+            flash(f'{count} retirada(s) lançada(s) com sucesso!', 'success')
+        else:
+            person = request.form.get('person')
+            db.add_manual_withdrawal(month, person, parse_amount(request.form.get('amount')))
+            flash(f'Retirada de {person} adicionada com sucesso!', 'success')
+    except ValueError as e:
+        flash(f'Erro: {e}', 'error')
     
     return redirect(url_for('dashboard', month=month))
 
-@app.route('/delete_withdrawal/<int:withdrawal_id>', methods=['POST'])
-def delete_withdrawal(withdrawal_id):
-    success, message = db.delete_manual_withdrawal(withdrawal_id)
+@app.route('/api/withdrawals', methods=['POST'])
+def api_withdrawals():
+    """Lançamento em lote: {"month": ..., "entries": [{"partner", "amount", "month"?}]}, tudo ou nada."""
+    payload = request.get_json(silent=True) or {}
+    entries = payload.get('entries')
+    if not isinstance(entries, list) or not entries:
+        return jsonify({'error': "Informe 'entries' com ao menos uma retirada."}), 400
+    if not all(isinstance(entry, dict) for entry in entries):
+        return jsonify({'error': "Cada retirada deve ter 'partner' e 'amount'."}), 400
+    try:
+        count = db.add_withdrawals([(entry.get('month') or payload.get('month'), entry.get('partner'),
+                                     parse_amount(entry.get('amount'))) for entry in entries])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'created': count}), 201
+
+@app.route('/reverse_withdrawal/<int:withdrawal_id>', methods=['POST'])
+def reverse_withdrawal(withdrawal_id):
+    success, message = db.reverse_withdrawal(withdrawal_id)
     if success:
-        flash('Retirada excluída com sucesso!', 'success')
+        flash('Retirada estornada com sucesso!', 'success')
     else:
         flash(f'Erro: {message}', 'error')
     
@@ -279,3 +657,59 @@ def compare():
                            selected_months=selected_months,
                            totals_comparison=totals_comparison,
                            category_comparison=category_comparison)
+
+def consolidated_data():
+    """Totais de todos os escritórios nos meses escolhidos (?month=...); só fora do prefixo de um escritório."""
+    if not db.TENANT_DATA_DIR or db.current_tenant.get() is not None:
+        abort(404)
+    return db.get_consolidated_data(sorted(set(request.args.getlist('month'))))
+
+@app.route('/api/consolidated')
+def api_consolidated():
+    return jsonify(consolidated_data())
+
+@app.route('/consolidated')
+def consolidated():
+    return render_template('consolidated.html', **consolidated_data())
+
+@app.route('/export/<string:table>')
+def export(table):
+    """Exporta totals, expenses ou withdrawals (livro de retiradas) no período (?start=&end=) em CSV, Parquet ou Arrow."""
+    if table not in db.EXPORT_COLUMNS:
+        abort(404)
+    fmt = request.args.get('format', 'csv')
+    if fmt not in exports.FORMATS:
+        flash(f"Formato de exportação inválido: {fmt}. Use csv, parquet ou arrow.", 'error')
+        return redirect(url_for('dashboard'))
+    try:
+        start, end = period_args()
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('dashboard'))
+    try:
+        stream = exports.export_stream(table, fmt, start, end)
+    except exports.ExportUnavailable as e:
+        flash(str(e), 'error')
+        return redirect(url_for('dashboard'))
+
+    mimetype, extension = exports.FORMATS[fmt]
+    period = '_'.join(part for part in (start, end) if part) or 'completo'
+    response = app.response_class(stream_with_context(stream), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{table}_{period}.{extension}"'
+    return response
+
+@app.route('/search')
+def search():
+    text, page, per_page = search_args()
+    return render_template('search.html', search=db.search_expenses(text, page, per_page))
+
+@app.route('/trends')
+def trends():
+    start = request.args.get('start') or None
+    end = request.args.get('end') or None
+    trend = db.get_trend_data(start, end)
+    return render_template('trends.html',
+                           months=sorted(db.get_available_months()),
+                           start=start,
+                           end=end,
+                           trend=trend)
@@ -0,0 +1,207 @@
+"""Benchmarks do dashboard com planilhas e bancos sintéticos.
+
+Uso:
+    python benchmark.py --rows 2000 --years 10 --iterations 20 --output resultado.json
+
+Gera planilhas "Página 1" no formato do relatório mensal, popula um banco
+temporário com N anos de meses e mede process_excel, as consultas do
+dashboard/comparação e as rotas do Flask (via test client). O resultado é um
+JSON com p50/p95 (em ms) e pico de memória (tracemalloc) de cada medição,
+para comparar entre commits.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+from openpyxl import Workbook
+
+import database as db
+from excel_parser import CATEGORIES, SHEET_NAME
+
+FEE_DESCRIPTIONS = ['Honorários Contábeis', 'Honorários Trabalhistas', 'Honorário Abertura de Empresa']
+
+
+def format_br(value):
+    """Formata um número no padrão brasileiro (1.234,56)."""
+    return f'{value:,.2f}'.replace(',', 'X').replace('.', ',').replace('X', '.')
+
+
+def generate_workbook(path, rows=2000, month='2025-01', seed=0):
+    """Gera uma planilha sintética com `rows` lançamentos e os totais nas colunas K/L."""
+    rng = random.Random(seed)
+    year, month_number = month.split('-')
+    subcategories = [sub for subs in CATEGORIES.values() for sub in subs]
+
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.title = SHEET_NAME
+    sheet.append([f'Período: 01/{month_number}/{year} à 28/{month_number}/{year}'])
+    sheet.append(['Data', 'Descrição', 'Documento', 'Total'])
+
+    revenue = expenses = 0.0
+    for index in range(rows):
+        amount = round(rng.uniform(10, 5000), 2)
+        if rng.random() < 0.15:
+            description = rng.choice(FEE_DESCRIPTIONS)
+            revenue += amount
+        else:
+            description = rng.choice(subcategories)
+            expenses += amount
+        # Alterna valores numéricos e texto no formato brasileiro, como nos relatórios reais
+        total = amount if index % 3 else format_br(amount)
+        sheet.append([f'{rng.randint(1, 28):02d}/{month_number}/{year}', description, index, total])
+
+    sheet.append([None] * 10 + ['Receitas:', format_br(revenue)])
+    sheet.append([None] * 10 + ['Despesas:', round(expenses, 2)])
+    workbook.save(path)
+    return path
+
+
+def synthetic_month(month, rows, rng):
+    """Dados já processados de um mês (mesmo formato de excel_parser.parse_excel)."""
+    expenses_data = []
+    for _ in range(rows):
+        category = rng.choice(list(CATEGORIES))
+        expenses_data.append((month, category, rng.choice(CATEGORIES[category]), round(rng.uniform(10, 5000), 2)))
+    total_expenses = sum(expense[3] for expense in expenses_data)
+    total_revenue = total_expenses * rng.uniform(1.1, 1.6)
+    net_profit = total_revenue - total_expenses
+    totals_data = {
+        'month': month, 'total_revenue': total_revenue, 'total_expenses': total_expenses,
+        'total_fees': total_revenue * 0.8, 'net_profit': net_profit,
+        'profit_margin': net_profit / total_revenue * 100,
+    }
+    return {'month': month, 'totals_data': totals_data, 'expenses_data': expenses_data}
+
+
+def seed_database(years=10, rows_per_month=300, end_year=2025, seed=0):
+    """Popula o banco configurado em db.DATABASE com `years` anos de meses e retorna os meses."""
+    rng = random.Random(seed)
+    months = [f'{year}-{month:02d}' for year in range(end_year - years + 1, end_year + 1) for month in range(1, 13)]
+    db.init_db()
+    db.save_processed_excel_batch([synthetic_month(month, rows_per_month, rng) for month in months])
+    return months
+
+
+def measure(fn, iterations, setup=None):
+    """Executa `fn` várias vezes e retorna p50/p95/min/máx em ms e o pico de memória em KiB."""
+    samples = []
+    for _ in range(iterations):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+
+    # Uma execução extra só para medir memória (tracemalloc distorce o tempo)
+    if setup:
+        setup()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    samples.sort()
+    return {
+        'n': len(samples),
+        'p50_ms': samples[len(samples) // 2],
+        'p95_ms': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'min_ms': samples[0],
+        'max_ms': samples[-1],
+        'peak_memory_kib': peak / 1024,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(workdir, rows, years, rows_per_month, iterations):
+    db.DATABASE = os.path.join(workdir, 'benchmark.db')
+    months = seed_database(years, rows_per_month)
+
+    # Importa o app só depois de apontar o banco para o arquivo temporário
+    import app as app_module
+    from excel_parser import parse_excel_pandas, parse_excel_streaming
+
+    workbook_month = '2030-01'
+    workbook = generate_workbook(os.path.join(workdir, 'relatorio.xlsx'), rows, workbook_month)
+    compare_months = months[-12:]
+    client = app_module.app.test_client()
+    clear_cache = db.result_cache.clear
+    partners = [partner['name'] for partner in db.get_partners() if partner['active']]
+    bulk_withdrawals = [(compare_months[i % len(compare_months)], partners[i % len(partners)], 100.0)
+                        for i in range(100)]
+
+    results = {
+        'parse_excel_streaming': measure(lambda: parse_excel_streaming(workbook), iterations),
+        'parse_excel_pandas': measure(lambda: parse_excel_pandas(workbook), max(1, iterations // 4)),
+        'process_excel_new_month': measure(lambda: app_module.process_excel(workbook), iterations,
+                                           setup=lambda: db.delete_all_month_data(workbook_month)),
+        'process_excel_reupload': measure(lambda: app_module.process_excel(workbook), iterations),
+        'get_dashboard_data': measure(lambda: db.get_dashboard_data(months[-1]), iterations, setup=clear_cache),
+        'get_dashboard_data_cached': measure(lambda: db.get_dashboard_data(months[-1]), iterations),
+        'get_compare_data_12_months': measure(lambda: db.get_compare_data(compare_months), iterations,
+                                              setup=clear_cache),
+        'add_withdrawals_bulk_100': measure(lambda: db.add_withdrawals(bulk_withdrawals), iterations),
+        'get_trend_data_full_history': measure(lambda: db.get_trend_data(), iterations, setup=clear_cache),
+    }
+
+    routes = {
+        'route_dashboard': f'/?month={months[-1]}',
+        'route_compare': '/compare?' + '&'.join(f'month={month}' for month in compare_months),
+        'route_trends': '/trends',
+        'route_api_dashboard': f'/api/dashboard/{months[-1]}',
+        'route_api_search': '/api/search?q=reembolso',
+    }
+    for name, url in routes.items():
+        def request_route(url=url):
+            response = client.get(url)
+            assert response.status_code == 200, (url, response.status_code)
+        results[name] = measure(request_route, iterations, setup=clear_cache)
+
+    return {
+        'generated_at': datetime.now().isoformat(timespec='seconds'),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'sqlite': db.sqlite3.sqlite_version,
+        'parameters': {'rows': rows, 'years': years, 'rows_per_month': rows_per_month, 'iterations': iterations},
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=2000, help='linhas da planilha sintética')
+    parser.add_argument('--years', type=int, default=10, help='anos de histórico no banco')
+    parser.add_argument('--rows-per-month', type=int, default=300, help='despesas por mês no banco')
+    parser.add_argument('--iterations', type=int, default=20, help='repetições de cada medição')
+    parser.add_argument('--output', help='arquivo JSON de saída (padrão: stdout)')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix='contajur-bench-') as workdir:
+        report = run_benchmarks(workdir, args.rows, args.years, args.rows_per_month, args.iterations)
+        db.close_db_connection()
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as handle:
+            handle.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
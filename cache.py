@@ -0,0 +1,64 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Cache LRU limitado e seguro entre threads.
+
+    Cada entrada guarda a versão dos dados com que foi calculada; uma leitura com
+    outra versão conta como falta e descarta a entrada. Os valores devolvidos
+    são compartilhados entre requisições e não devem ser modificados.
+    """
+
+    MISSING = object()
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, version):
+        """Retorna o valor guardado para `key` na `version` ou LRUCache.MISSING."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return self.MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, version, value):
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_build(self, key, version, build):
+        """Busca no cache ou calcula com `build()` e guarda o resultado."""
+        value = self.get(key, version)
+        if value is self.MISSING:
+            value = build()
+            self.put(key, version, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
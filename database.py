@@ -1,95 +1,907 @@
 import sqlite3
 import os
-from collections import defaultdict
+import contextvars
+import json
+import logging
+import re
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import metrics
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
 
 DATABASE = os.path.join("/mnt/data/", "contajur.db")
 
-def get_db_connection():
-    """Cria uma conexão com o banco de dados."""
-    conn = sqlite3.connect(DATABASE)
+# Ajustes do SQLite (podem ser sobrescritos por variáveis de ambiente)
+SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL').upper()
+SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE', -16000))  # negativo = KiB
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 64 * 1024 * 1024))
+SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))  # ms
+
+if SQLITE_SYNCHRONOUS not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+    raise ValueError(f"SQLITE_SYNCHRONOUS inválido: {SQLITE_SYNCHRONOUS}")
+
+# Top 10 de despesas operacionais: reembolsos a clientes não entram no ranking
+TOP_EXPENSES_LIMIT = 10
+TOP_EXPENSES_EXCLUDED_CATEGORY = 'Reembolsos a Clientes'
+
+# Cache dos dados de leitura, invalidado pela versão gravada em data_versions
+result_cache = LRUCache(maxsize=int(os.environ.get('RESULT_CACHE_SIZE', 256)))
+ALL_MONTHS_SCOPE = '*'
+
+def _cache_metrics():
+    stats = result_cache.stats()
+    return [('contajur_result_cache_hits_total', {}, stats['hits']),
+            ('contajur_result_cache_misses_total', {}, stats['misses']),
+            ('contajur_result_cache_evictions_total', {}, stats['evictions']),
+            ('contajur_result_cache_entries', {}, stats['size'])]
+
+metrics.register_collector(_cache_metrics)
+
+# Log de consultas lentas, desligado por padrão (ex.: SLOW_QUERY_MS=200)
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 0))
+slow_query_logger = logging.getLogger('contajur.slow_query')
+
+_STATEMENT_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE(?:\s+IF\s+NOT\s+EXISTS)?|ON)\s+(\w+)', re.IGNORECASE)
+
+@lru_cache(maxsize=512)
+def statement_label(sql):
+    """Rótulo curto do comando para as métricas: verbo e primeira tabela (ex.: 'SELECT totals')."""
+    verb = sql.split(None, 1)[0].upper() if sql.strip() else ''
+    match = _STATEMENT_TABLE.search(sql)
+    return f'{verb} {match.group(1)}' if match else verb
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor que registra a duração e as linhas de cada comando nas métricas.
+
+    Em um SELECT, o tempo e as linhas de leitura (fetch/iteração) são somados
+    ao comando; o registro é feito quando as linhas acabam, no próximo
+    execute ou quando o cursor é fechado/descartado.
+    """
+    _statement = None  # [sql, parâmetros, segundos, linhas]
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._begin(sql, parameters, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._begin(sql, '<executemany>', time.perf_counter() - start)
+
+    def _begin(self, sql, parameters, elapsed):
+        self._statement = [sql, parameters, elapsed, 0]
+        if self.description is None:
+            # Sem linhas para ler (INSERT/UPDATE/DELETE, DDL, PRAGMA de escrita)
+            self._statement[3] = max(self.rowcount, 0)
+            self._finish()
+
+    def _finish(self):
+        statement = self._statement
+        if statement is None:
+            return
+        self._statement = None
+        sql, parameters, elapsed, rows = statement
+        label = statement_label(sql)
+        metrics.observe('contajur_db_statement_duration_seconds', elapsed, statement=label)
+        metrics.inc('contajur_db_rows_total', rows, statement=label)
+        if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+            slow_query_logger.warning('Consulta lenta (%.1f ms, %d linha(s)): %s | parâmetros: %r',
+                                      elapsed * 1000, rows, ' '.join(sql.split()), parameters)
+
+    def _fetched(self, elapsed, rows, exhausted):
+        if self._statement is not None:
+            self._statement[2] += elapsed
+            self._statement[3] += rows
+            if exhausted:
+                self._finish()
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(time.perf_counter() - start, 0, True)
+            raise
+        self._fetched(time.perf_counter() - start, 1, False)
+        return row
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(time.perf_counter() - start, row is not None, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(time.perf_counter() - start, len(rows), not rows)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(time.perf_counter() - start, len(rows), True)
+        return rows
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        self._finish()
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Conexão cujos cursores (inclusive os de conn.execute) são InstrumentedCursor."""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+# Vários escritórios (tenants), cada um com o próprio arquivo SQLite em TENANT_DATA_DIR.
+# Sem TENANT_DATA_DIR o app atende só o banco DATABASE, como antes.
+TENANT_DATA_DIR = os.environ.get('TENANT_DATA_DIR') or None
+# Escritórios liberados mesmo antes de o arquivo existir (separados por vírgula)
+TENANTS = tuple(name.strip() for name in os.environ.get('TENANTS', '').split(',') if name.strip())
+TENANT_NAME_PATTERN = re.compile(r'^[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?$')
+# Conexões ociosas mantidas abertas, somando todos os bancos
+SQLITE_POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE', 32))
+
+# Escritório da requisição ou do job atual (None = banco DATABASE)
+current_tenant = contextvars.ContextVar('tenant', default=None)
+
+def is_valid_tenant(name):
+    return bool(name) and TENANT_NAME_PATTERN.match(name) is not None
+
+def database_path(tenant=None):
+    """Caminho do banco do escritório (do atual, se omitido)."""
+    tenant = tenant if tenant is not None else current_tenant.get()
+    if tenant is None:
+        return DATABASE
+    if not TENANT_DATA_DIR or not is_valid_tenant(tenant):
+        raise ValueError(f"Escritório inválido: {tenant}")
+    return os.path.join(TENANT_DATA_DIR, f'{tenant}.db')
+
+def list_tenants():
+    """Escritórios conhecidos: os de TENANTS e os que já têm arquivo em TENANT_DATA_DIR."""
+    if not TENANT_DATA_DIR:
+        return []
+    try:
+        files = [name[:-3] for name in os.listdir(TENANT_DATA_DIR) if name.endswith('.db')]
+    except FileNotFoundError:
+        files = []
+    return sorted(name for name in set(TENANTS) | set(files) if is_valid_tenant(name))
+
+def tenant_exists(name):
+    """Um escritório é atendido se estiver em TENANTS ou já tiver banco; o arquivo é criado no primeiro acesso."""
+    if not TENANT_DATA_DIR or not is_valid_tenant(name):
+        return False
+    return name in TENANTS or os.path.exists(database_path(name))
+
+def _connect(path=None):
+    """Abre uma nova conexão em modo WAL com os PRAGMAs configurados."""
+    path = path or database_path()
+    if path != DATABASE:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    # check_same_thread=False: devolvida ao pool, a conexão pode ser usada por outra
+    # thread (nunca por duas ao mesmo tempo)
+    conn = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT / 1000, factory=InstrumentedConnection,
+                           check_same_thread=False)
     conn.row_factory = sqlite3.Row  # Permite acessar colunas por nome
+    # WAL: leitores não bloqueiam o escritor e vice-versa
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute(f'PRAGMA synchronous = {SQLITE_SYNCHRONOUS}')
+    conn.execute(f'PRAGMA cache_size = {SQLITE_CACHE_SIZE:d}')
+    conn.execute(f'PRAGMA mmap_size = {SQLITE_MMAP_SIZE:d}')
+    conn.execute(f'PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT:d}')
     return conn
 
+class ConnectionPool:
+    """Conexões ociosas de vários bancos, no máximo `maxsize` no total.
+
+    Uma conexão devolvida pode ser reaproveitada por qualquer thread que peça o
+    mesmo banco. Acima do limite, as ociosas do banco usado há mais tempo são
+    fechadas (LRU); as em uso ficam limitadas pelo número de threads.
+    """
+
+    def __init__(self, connect, maxsize):
+        self._connect = connect
+        self.maxsize = maxsize
+        self._idle = OrderedDict()  # caminho -> [conexões], do menos para o mais recente
+        self._idle_count = 0
+        self._lock = threading.Lock()
+        self.in_use = 0
+        self.opened = 0
+        self.reused = 0
+        self.evictions = 0
+
+    def acquire(self, path):
+        with self._lock:
+            self.in_use += 1
+            connections = self._idle.get(path)
+            if connections:
+                conn = connections.pop()
+                if not connections:
+                    del self._idle[path]
+                self._idle_count -= 1
+                self.reused += 1
+                return conn
+            self.opened += 1
+        try:
+            return self._connect(path)
+        except Exception:
+            with self._lock:
+                self.in_use -= 1
+            raise
+
+    def release(self, path, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        evicted = []
+        with self._lock:
+            self.in_use -= 1
+            self._idle.setdefault(path, []).append(conn)
+            self._idle.move_to_end(path)
+            self._idle_count += 1
+            while self._idle_count > self.maxsize:
+                oldest, connections = next(iter(self._idle.items()))
+                evicted.append(connections.pop(0))
+                if not connections:
+                    del self._idle[oldest]
+                self._idle_count -= 1
+                self.evictions += 1
+        for conn in evicted:
+            conn.close()
+
+    def close_idle(self):
+        """Fecha todas as conexões ociosas (ex.: no processo mestre, antes do fork dos workers)."""
+        with self._lock:
+            connections = [conn for idle in self._idle.values() for conn in idle]
+            self._idle.clear()
+            self._idle_count = 0
+        for conn in connections:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            return {'idle': self._idle_count, 'in_use': self.in_use, 'databases': len(self._idle),
+                    'maxsize': self.maxsize, 'opened': self.opened, 'reused': self.reused,
+                    'evictions': self.evictions}
+
+connection_pool = ConnectionPool(_connect, SQLITE_POOL_SIZE)
+
+def _pool_metrics():
+    stats = connection_pool.stats()
+    return [('contajur_db_pool_opened_total', {}, stats['opened']),
+            ('contajur_db_pool_reused_total', {}, stats['reused']),
+            ('contajur_db_pool_evictions_total', {}, stats['evictions']),
+            ('contajur_db_pool_idle_connections', {}, stats['idle']),
+            ('contajur_db_pool_in_use_connections', {}, stats['in_use'])]
+
+metrics.register_collector(_pool_metrics)
+
+# A thread fica com uma conexão do pool, reaproveitada por todas as chamadas da mesma requisição
+_local = threading.local()
+
+def get_db_connection():
+    """Retorna a conexão da thread para o banco do escritório atual, pegando uma do pool se necessário.
+
+    Na primeira conexão do processo a um banco, aplica as migrações pendentes.
+    """
+    path = database_path()
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.path == path:
+        return conn
+    if conn is not None:
+        close_db_connection()
+    conn = connection_pool.acquire(path)
+    _local.conn, _local.path = conn, path
+    _ensure_migrated(path)
+    return conn
+
+def close_db_connection(exception=None):
+    """Devolve ao pool a conexão da thread atual (registrada no teardown do Flask)."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        _local.conn = None
+        connection_pool.release(_local.path, conn)
+
+def _migration_base_schema(conn):
+    """Esquema original; também completa bancos criados por versões anteriores do app."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS expenses (
+        id INTEGER PRIMARY KEY, month TEXT, category TEXT, subcategory TEXT, amount REAL
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS totals (
+        id INTEGER PRIMARY KEY, month TEXT UNIQUE, total_revenue REAL,
+        total_expenses REAL, total_fees REAL, net_profit REAL, profit_margin REAL,
+        share_lucas REAL, share_thiago REAL, share_ronaldo REAL, share_reserva REAL
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS withdrawals (
+        id INTEGER PRIMARY KEY, month TEXT, person TEXT, amount REAL,
+        source TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS ingest_jobs (
+        id TEXT PRIMARY KEY, filename TEXT, status TEXT, month TEXT, message TEXT, report TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP, updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )''')
+    job_columns = [row['name'] for row in conn.execute('PRAGMA table_info(ingest_jobs)')]
+    if 'report' not in job_columns:
+        conn.execute('ALTER TABLE ingest_jobs ADD COLUMN report TEXT')
+
+def _migration_month_indexes(conn):
+    """Índices por mês usados pelo dashboard, comparação e exclusão de meses."""
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_expenses_month_category_amount ON expenses (month, category, amount)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_expenses_month_amount ON expenses (month, amount)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_withdrawals_month_timestamp ON withdrawals (month, timestamp)')
+
+def _migration_month_aggregates(conn):
+    """Tabelas materializadas por mês (totais por categoria e top 10), com carga inicial."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS category_totals (
+        month TEXT, category TEXT, total REAL, PRIMARY KEY (month, category)
+    ) WITHOUT ROWID''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS top_expenses (
+        month TEXT, rank INTEGER, subcategory TEXT, amount REAL, PRIMARY KEY (month, rank)
+    ) WITHOUT ROWID''')
+    conn.execute('''INSERT OR REPLACE INTO category_totals (month, category, total)
+                    SELECT month, category, SUM(amount) FROM expenses GROUP BY month, category''')
+    conn.execute(f'''INSERT OR REPLACE INTO top_expenses (month, rank, subcategory, amount)
+                    SELECT month, rank, subcategory, amount FROM (
+                        SELECT month, subcategory, amount,
+                               ROW_NUMBER() OVER (PARTITION BY month ORDER BY amount DESC) AS rank
+                        FROM expenses WHERE category != ?
+                    ) WHERE rank <= {TOP_EXPENSES_LIMIT:d}''', (TOP_EXPENSES_EXCLUDED_CATEGORY,))
+
+def _migration_data_versions(conn):
+    """Contador de versão por mês (e global), usado para invalidar caches entre processos."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS data_versions (
+        scope TEXT PRIMARY KEY, version INTEGER NOT NULL
+    ) WITHOUT ROWID''')
+
+def _migration_categories(conn):
+    """Tabela de categorização (subcategoria -> categoria), editável sem novo deploy."""
+    from excel_parser import DEFAULT_CATEGORY_MAP
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS categories (
+        subcategory TEXT PRIMARY KEY, category TEXT NOT NULL, position INTEGER NOT NULL
+    )''')
+    conn.executemany('INSERT OR IGNORE INTO categories (subcategory, category, position) VALUES (?, ?, ?)',
+                     [(subcategory, category, position)
+                      for position, (subcategory, category) in enumerate(DEFAULT_CATEGORY_MAP.items())])
+
+def _migration_uploads(conn):
+    """Hash SHA-256 de cada arquivo importado, para ignorar reenvios idênticos."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS uploads (
+        sha256 TEXT PRIMARY KEY, month TEXT NOT NULL, filename TEXT,
+        uploaded_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_uploads_month ON uploads (month)')
+
+def _migration_expense_search(conn):
+    """Busca textual (FTS5) nas descrições das despesas, sobre os totais por mês e subcategoria.
+
+    O índice cobre uma linha por (mês, categoria, subcategoria) em vez de uma por
+    lançamento: as descrições se repetem muito, então a busca e a soma por mês
+    percorrem poucas linhas mesmo com centenas de milhares de despesas.
+    """
+    conn.execute('''CREATE TABLE IF NOT EXISTS subcategory_totals (
+        id INTEGER PRIMARY KEY, month TEXT NOT NULL, category TEXT NOT NULL, subcategory TEXT NOT NULL,
+        total REAL NOT NULL, entries INTEGER NOT NULL, UNIQUE (month, category, subcategory)
+    )''')
+    conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS expense_search USING fts5(
+        subcategory, category, content='subcategory_totals', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )''')
+    # Triggers mantêm o índice externo em sincronia; mudar só o total não reindexa o texto
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS subcategory_totals_ai AFTER INSERT ON subcategory_totals BEGIN
+        INSERT INTO expense_search (rowid, subcategory, category) VALUES (new.id, new.subcategory, new.category);
+    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS subcategory_totals_ad AFTER DELETE ON subcategory_totals BEGIN
+        INSERT INTO expense_search (expense_search, rowid, subcategory, category)
+        VALUES ('delete', old.id, old.subcategory, old.category);
+    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS subcategory_totals_au
+        AFTER UPDATE OF subcategory, category ON subcategory_totals BEGIN
+        INSERT INTO expense_search (expense_search, rowid, subcategory, category)
+        VALUES ('delete', old.id, old.subcategory, old.category);
+        INSERT INTO expense_search (rowid, subcategory, category) VALUES (new.id, new.subcategory, new.category);
+    END''')
+    conn.execute('''INSERT OR IGNORE INTO subcategory_totals (month, category, subcategory, total, entries)
+                    SELECT month, category, subcategory, SUM(amount), COUNT(*) FROM expenses
+                    GROUP BY month, category, subcategory''')
+
+def _migration_expense_anomalies(conn):
+    """Picos de gasto por mês e subcategoria (ver anomalies.py), com a carga inicial do histórico."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS expense_anomalies (
+        month TEXT, category TEXT, subcategory TEXT, amount REAL, baseline REAL, score REAL,
+        PRIMARY KEY (month, category, subcategory)
+    ) WITHOUT ROWID''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_expense_anomalies_month_score ON expense_anomalies (month, score)')
+    _refresh_expense_anomalies(conn)
+
+# Sócios iniciais e sua fração do lucro líquido (antes eram colunas share_* de totals)
+DEFAULT_PARTNERS = (('Lucas', 0.25), ('Thiago', 0.25), ('Ronaldo', 0.25), ('Reserva', 0.25))
+
+def _migration_withdrawal_ledger(conn):
+    """Sócios em tabela própria e livro de retiradas somente de inclusão.
+
+    Cada retirada é um lançamento; excluir vira um estorno (valor negativo que
+    aponta para o original em reverses_id). partner_balances acumula o total
+    por mês e sócio a cada lançamento. As retiradas da tabela antiga são
+    copiadas com os mesmos ids e a tabela é removida; as colunas share_* de
+    totals deixam de ser usadas.
+    """
+    conn.execute('''CREATE TABLE IF NOT EXISTS partners (
+        id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, share REAL NOT NULL,
+        position INTEGER NOT NULL, active INTEGER NOT NULL DEFAULT 1
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_partners_position ON partners (position)')
+    conn.executemany('INSERT OR IGNORE INTO partners (name, share, position) VALUES (?, ?, ?)',
+                     [(name, share, position) for position, (name, share) in enumerate(DEFAULT_PARTNERS)])
+    conn.execute('''CREATE TABLE IF NOT EXISTS withdrawal_ledger (
+        id INTEGER PRIMARY KEY, month TEXT NOT NULL, partner_id INTEGER NOT NULL REFERENCES partners (id),
+        amount REAL NOT NULL, source TEXT NOT NULL DEFAULT 'manual',
+        reverses_id INTEGER UNIQUE REFERENCES withdrawal_ledger (id),
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_withdrawal_ledger_month ON withdrawal_ledger (month)')
+    conn.execute('''CREATE TABLE IF NOT EXISTS partner_balances (
+        month TEXT, partner_id INTEGER, withdrawn REAL NOT NULL, entries INTEGER NOT NULL,
+        PRIMARY KEY (month, partner_id)
+    ) WITHOUT ROWID''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS withdrawal_ledger_no_update BEFORE UPDATE ON withdrawal_ledger BEGIN
+        SELECT RAISE(ABORT, 'O livro de retiradas não permite alterações; registre um estorno.');
+    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS withdrawal_ledger_no_delete BEFORE DELETE ON withdrawal_ledger BEGIN
+        SELECT RAISE(ABORT, 'O livro de retiradas não permite exclusões; registre um estorno.');
+    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS withdrawal_ledger_rollup AFTER INSERT ON withdrawal_ledger BEGIN
+        INSERT INTO partner_balances (month, partner_id, withdrawn, entries)
+        VALUES (new.month, new.partner_id, new.amount, 1)
+        ON CONFLICT (month, partner_id) DO UPDATE SET
+        withdrawn = withdrawn + excluded.withdrawn, entries = entries + 1;
+    END''')
+
+    legacy = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'withdrawals'").fetchone()
+    if legacy:
+        # Pessoas que não estão entre os sócios padrão entram inativas e sem participação no lucro
+        conn.execute('''INSERT OR IGNORE INTO partners (name, share, position, active)
+                        SELECT DISTINCT person, 0, (SELECT MAX(position) + 1 FROM partners), 0
+                        FROM withdrawals WHERE person IS NOT NULL''')
+        conn.execute('''INSERT INTO withdrawal_ledger (id, month, partner_id, amount, source, created_at)
+                        SELECT w.id, w.month, p.id, w.amount, COALESCE(w.source, 'manual'), w.timestamp
+                        FROM withdrawals w JOIN partners p ON p.name = w.person ORDER BY w.id''')
+        conn.execute('DROP TABLE withdrawals')
+
+def _migration_current_uploads(conn):
+    """Deixa em uploads só o arquivo aplicado por último a cada mês (um por mês).
+
+    Antes, um arquivo substituído por outro do mesmo mês continuava registrado
+    e seu reenvio era ignorado como idêntico.
+    """
+    conn.execute('''DELETE FROM uploads WHERE rowid NOT IN (
+                        SELECT MAX(rowid) FROM uploads GROUP BY month)''')
+    conn.execute('DROP INDEX IF EXISTS idx_uploads_month')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_uploads_month ON uploads (month)')
+
+def _migration_sparse_anomalies(conn):
+    """Recalcula os picos de gasto ignorando os meses sem lançamentos da subcategoria.
+
+    Antes esses meses contavam como zero, e despesas anuais (13° salário,
+    férias) eram marcadas todo ano.
+    """
+    _refresh_expense_anomalies(conn)
+
+def _migration_ingest_job_spools(conn):
+    """Arquivos temporários de cada job, para apagar só os de jobs já encerrados."""
+    conn.execute('ALTER TABLE ingest_jobs ADD COLUMN spool_files TEXT')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_ingest_jobs_spool_files ON ingest_jobs (status)
+                    WHERE spool_files IS NOT NULL''')
+
+def _migration_drop_expense_month_amount_index(conn):
+    """Remove idx_expenses_month_amount: o top 10 do dashboard vem de top_expenses.
+
+    Só o recálculo do top 10 na importação ainda o usaria, para ordenar as
+    despesas de um único mês; manter o índice custava uma entrada a mais em
+    cada despesa gravada.
+    """
+    conn.execute('DROP INDEX IF EXISTS idx_expenses_month_amount')
+
+# Migrações em ordem: a de índice N leva o banco para PRAGMA user_version = N + 1.
+# Nunca altere uma migração já publicada; acrescente uma nova ao final da lista.
+MIGRATIONS = [
+    _migration_base_schema,
+    _migration_month_indexes,
+    _migration_month_aggregates,
+    _migration_data_versions,
+    _migration_categories,
+    _migration_uploads,
+    _migration_expense_search,
+    _migration_expense_anomalies,
+    _migration_withdrawal_ledger,
+    _migration_current_uploads,
+    _migration_sparse_anomalies,
+    _migration_drop_expense_month_amount_index,
+    _migration_ingest_job_spools,
+]
+
 def init_db():
-    """Cria as tabelas do banco de dados se elas não existirem."""
+    """Cria ou atualiza o esquema aplicando as migrações pendentes (PRAGMA user_version)."""
+    conn = get_db_connection()
+    while True:
+        # BEGIN IMMEDIATE serializa workers que iniciam ao mesmo tempo
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version >= len(MIGRATIONS):
+                conn.rollback()
+                return version
+            MIGRATIONS[version](conn)
+            conn.execute(f'PRAGMA user_version = {version + 1:d}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+_schema_lock = threading.Lock()
+_schema_ready = set()
+
+def _ensure_migrated(path):
+    """Roda init_db() uma única vez por processo em cada banco (chamada ao pegar a conexão)."""
+    if path in _schema_ready:
+        return
+    with _schema_lock:
+        if path not in _schema_ready:
+            init_db()
+            _schema_ready.add(path)
+
+def ensure_schema():
+    """Garante o esquema do banco atual já migrado neste processo.
+
+    No gunicorn, o banco principal é migrado no processo mestre antes do fork
+    (gunicorn.conf.py) e os workers herdam o estado; os bancos dos escritórios
+    são migrados no primeiro acesso de cada worker.
+    """
+    get_db_connection()
+
+# Consultas de leitura do dashboard e da comparação; check_query_plans() confere
+# que todas usam índice ({placeholders} recebe os "?" da lista de meses).
+DASHBOARD_QUERIES = {
+    'months': 'SELECT DISTINCT month FROM totals ORDER BY month DESC',
+    'totals': 'SELECT * FROM totals WHERE month = ?',
+    'top_10': 'SELECT subcategory, amount FROM top_expenses WHERE month = ? ORDER BY rank',
+    'category_totals': 'SELECT category, total FROM category_totals WHERE month = ?',
+    'expenses': '''
+        SELECT category, subcategory, amount FROM expenses
+        WHERE month = ? ORDER BY category DESC, amount DESC
+    ''',
+    'partners': 'SELECT id, name, share, active FROM partners ORDER BY position',
+    'partner_balances': 'SELECT partner_id, withdrawn FROM partner_balances WHERE month = ?',
+    'withdrawals': '''
+        SELECT w.id, p.name AS partner, w.amount, w.source, w.reverses_id, w.created_at,
+               r.id AS reversed_by FROM withdrawal_ledger w
+        JOIN partners p ON p.id = w.partner_id
+        LEFT JOIN withdrawal_ledger r ON r.reverses_id = w.id
+        WHERE w.month = ? ORDER BY w.id DESC
+    ''',
+    'anomalies': '''
+        SELECT category, subcategory, amount, baseline, score FROM expense_anomalies
+        WHERE month = ? ORDER BY score DESC
+    ''',
+    'compare_totals': 'SELECT * FROM totals WHERE month IN ({placeholders}) ORDER BY month',
+    'compare_categories': '''
+        SELECT month, category, total FROM category_totals
+        WHERE month IN ({placeholders}) ORDER BY month, category
+    ''',
+}
+
+def check_query_plans():
+    """Roda EXPLAIN QUERY PLAN nas consultas do dashboard.
+
+    Retorna {nome: (usa_indice, [detalhes do plano])}. Uma consulta é reprovada
+    se varrer uma tabela sem índice ou precisar de B-tree temporária para ordenar.
+    """
+    results = {}
+    conn = get_db_connection()
+    for name, sql in DASHBOARD_QUERIES.items():
+        params = ('2000-01', '2000-02') if '{placeholders}' in sql else ('2000-01',)
+        sql = sql.format(placeholders='?, ?')
+        params = params if '?' in sql else ()
+        plan = [row['detail'] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+        full_scan = any(detail.startswith('SCAN') and 'INDEX' not in detail for detail in plan)
+        temp_sort = any('TEMP B-TREE' in detail for detail in plan)
+        results[name] = (not full_scan and not temp_sort, plan)
+    return results
+
+def _bump_data_version(c, month):
+    """Incrementa a versão do mês e a global (na transação da escrita)."""
+    c.executemany('''INSERT INTO data_versions (scope, version) VALUES (?, 1)
+                     ON CONFLICT (scope) DO UPDATE SET version = version + 1''',
+                  [(month,), (ALL_MONTHS_SCOPE,)])
+
+def _cached(key, version, build):
+    """result_cache.get_or_build com a chave prefixada pelo escritório atual."""
+    return result_cache.get_or_build((current_tenant.get(), *key), version, build)
+
+def get_data_versions(scopes):
+    """Retorna a tupla de versões atuais dos escopos (meses ou ALL_MONTHS_SCOPE)."""
+    placeholders = ','.join('?' for _ in scopes)
+    rows = get_db_connection().execute(
+        f'SELECT scope, version FROM data_versions WHERE scope IN ({placeholders})', list(scopes)
+    ).fetchall()
+    versions = {row['scope']: row['version'] for row in rows}
+    return tuple(versions.get(scope, 0) for scope in scopes)
+
+def _refresh_month_aggregates(c, month):
+    """Recalcula category_totals, top_expenses e subcategory_totals de um mês (na transação corrente)."""
+    c.execute('DELETE FROM category_totals WHERE month = ?', (month,))
+    c.execute('''INSERT INTO category_totals (month, category, total)
+                 SELECT month, category, SUM(amount) FROM expenses
+                 WHERE month = ? GROUP BY month, category''', (month,))
+    c.execute('DELETE FROM top_expenses WHERE month = ?', (month,))
+    c.execute('''INSERT INTO top_expenses (month, rank, subcategory, amount)
+                 SELECT month, ROW_NUMBER() OVER (ORDER BY amount DESC), subcategory, amount
+                 FROM expenses WHERE month = ? AND category != ?
+                 ORDER BY amount DESC LIMIT ?''',
+              (month, TOP_EXPENSES_EXCLUDED_CATEGORY, TOP_EXPENSES_LIMIT))
+    # Upsert em vez de recriar: as linhas que continuam no mês mantêm o id e a entrada no índice de busca
+    c.execute('''DELETE FROM subcategory_totals WHERE month = ? AND (category, subcategory) NOT IN (
+                     SELECT category, subcategory FROM expenses WHERE month = ?)''', (month, month))
+    c.execute('''INSERT INTO subcategory_totals (month, category, subcategory, total, entries)
+                 SELECT month, category, subcategory, SUM(amount), COUNT(*) FROM expenses
+                 WHERE month = ? GROUP BY month, category, subcategory
+                 ON CONFLICT (month, category, subcategory) DO UPDATE SET
+                 total = excluded.total, entries = excluded.entries''', (month,))
+
+def _refresh_expense_anomalies(c):
+    """Recalcula expense_anomalies com todo o histórico (na transação corrente).
+
+    A análise é refeita inteira (leva milissegundos), mas só os meses cujos
+    alertas mudaram são regravados e têm a versão incrementada.
+    """
+    import anomalies
+
+    months = [row['month'] for row in c.execute('SELECT month FROM totals ORDER BY month')]
+    # Descrições que diferem só por espaços nas pontas formam a mesma série (build_matrix soma as duas)
+    rows = [(month, category, subcategory.strip(), total) for month, category, subcategory, total in
+            c.execute('SELECT month, category, subcategory, total FROM subcategory_totals').fetchall()]
+    detected = defaultdict(set)
+    for month, category, subcategory, amount, baseline, score in anomalies.detect(months, rows):
+        detected[month].add((category, subcategory, round(amount, 2), round(baseline, 2), round(score, 4)))
+    stored = defaultdict(set)
+    for row in c.execute('SELECT month, category, subcategory, amount, baseline, score FROM expense_anomalies'):
+        stored[row['month']].add((row['category'], row['subcategory'], row['amount'], row['baseline'], row['score']))
+
+    for month in detected.keys() | stored.keys():
+        if detected[month] == stored[month]:
+            continue
+        c.execute('DELETE FROM expense_anomalies WHERE month = ?', (month,))
+        c.executemany('''INSERT INTO expense_anomalies (month, category, subcategory, amount, baseline, score)
+                         VALUES (?, ?, ?, ?, ?, ?)''', [(month, *anomaly) for anomaly in detected[month]])
+        _bump_data_version(c, month)
+
+def _diff_expense_group(old_rows, new_amounts):
+    """Casa as linhas antigas [(id, valor)] com os novos valores de uma subcategoria.
+
+    Valores iguais são casados primeiro; as sobras são pareadas em ordem
+    (viram UPDATE) e o excedente vira INSERT ou DELETE.
+    Retorna (novos valores a inserir, [(valor, id)] a atualizar, [id] a excluir, inalteradas).
+    """
+    available = Counter(new_amounts)
+    matched = Counter()
+    unmatched_old = []
+    for row_id, amount in old_rows:
+        if available[amount]:
+            available[amount] -= 1
+            matched[amount] += 1
+        else:
+            unmatched_old.append((row_id, amount))
+    # Sobras na ordem original, sem as primeiras ocorrências de cada valor casado
+    pending_new = []
+    for amount in new_amounts:
+        if matched[amount]:
+            matched[amount] -= 1
+        else:
+            pending_new.append(amount)
+    unchanged = len(old_rows) - len(unmatched_old)
+    paired = min(len(unmatched_old), len(pending_new))
+    updates = [(amount, row_id) for (row_id, _), amount in zip(unmatched_old, pending_new)]
+    deletes = [row_id for row_id, _ in unmatched_old[paired:]]
+    return pending_new[paired:], updates, deletes, unchanged
+
+def _apply_month_data(c, month, totals_data, expenses_data):
+    """Aplica os dados de um mês vindos do Excel como diferença em relação ao que já está
+    gravado (usa o cursor da transação corrente) e retorna o resumo das alterações.
+
+    O livro de retiradas não é tocado: os saldos dos sócios são calculados na leitura.
+    """
+    # Totais: uma linha por mês, atualizada no lugar
+    c.execute('''INSERT INTO totals (month, total_revenue, total_expenses, total_fees, net_profit, 
+                 profit_margin)
+                 VALUES (:month, :total_revenue, :total_expenses, :total_fees, :net_profit, 
+                 :profit_margin)
+                 ON CONFLICT (month) DO UPDATE SET
+                 total_revenue = excluded.total_revenue, total_expenses = excluded.total_expenses,
+                 total_fees = excluded.total_fees, net_profit = excluded.net_profit,
+                 profit_margin = excluded.profit_margin''', 
+                 totals_data)
+
+    # Despesas: insere, altera ou remove apenas as linhas que mudaram
+    old_groups = defaultdict(list)
+    for row in c.execute('SELECT id, category, subcategory, amount FROM expenses WHERE month = ? ORDER BY id', (month,)):
+        old_groups[(row['category'], row['subcategory'])].append((row['id'], row['amount']))
+    new_groups = defaultdict(list)
+    for _, category, subcategory, amount in expenses_data:
+        new_groups[(category, subcategory)].append(amount)
+
+    inserts, updates, deletes = [], [], []
+    summary = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+    for key in new_groups.keys() | old_groups.keys():
+        group_inserts, group_updates, group_deletes, unchanged = _diff_expense_group(
+            old_groups.get(key, []), new_groups.get(key, []))
+        inserts.extend((month, key[0], key[1], amount) for amount in group_inserts)
+        updates.extend(group_updates)
+        deletes.extend((row_id,) for row_id in group_deletes)
+        summary['unchanged'] += unchanged
+    c.executemany('DELETE FROM expenses WHERE id = ?', deletes)
+    c.executemany('UPDATE expenses SET amount = ? WHERE id = ?', updates)
+    c.executemany('INSERT INTO expenses (month, category, subcategory, amount) VALUES (?, ?, ?, ?)', inserts)
+    summary.update(inserted=len(inserts), updated=len(updates), deleted=len(deletes))
+
+    if inserts or updates or deletes:
+        _refresh_month_aggregates(c, month)
+    _bump_data_version(c, month)
+    return summary
+
+def save_processed_excel_data(month, totals_data, expenses_data, upload=None):
+    """Salva todos os dados processados de um arquivo Excel de forma transacional.
+
+    `upload` ({'sha256', 'filename'}) registra o arquivo de origem para que um
+    reenvio idêntico seja reconhecido. Retorna o resumo das alterações nas despesas.
+    """
+    return save_processed_excel_batch([{
+        "month": month, "totals_data": totals_data,
+        "expenses_data": expenses_data, "upload": upload
+    }])[0]
+
+def save_processed_excel_batch(parsed_batch):
+    """Salva vários meses processados (saída de excel_parser.parse_excel) em uma única transação.
+
+    Cada item pode trazer a chave 'upload' ({'sha256', 'filename'}). Retorna a
+    lista de resumos das alterações, na mesma ordem.
+    """
+    summaries = []
     with get_db_connection() as conn:
         c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS expenses (
-            id INTEGER PRIMARY KEY, month TEXT, category TEXT, subcategory TEXT, amount REAL
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS totals (
-            id INTEGER PRIMARY KEY, month TEXT UNIQUE, total_revenue REAL,
-            total_expenses REAL, total_fees REAL, net_profit REAL, profit_margin REAL,
-            share_lucas REAL, share_thiago REAL, share_ronaldo REAL, share_reserva REAL
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS withdrawals (
-            id INTEGER PRIMARY KEY, month TEXT, person TEXT, amount REAL,
-            source TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        )''')
+        for parsed in parsed_batch:
+            summaries.append(_apply_month_data(c, parsed['month'], parsed['totals_data'],
+                                               parsed['expenses_data']))
+            # Só o arquivo aplicado por último vale como "idêntico" para o mês
+            c.execute('DELETE FROM uploads WHERE month = ?', (parsed['month'],))
+            if parsed.get('upload'):
+                c.execute('''INSERT OR REPLACE INTO uploads (sha256, month, filename)
+                             VALUES (?, ?, ?)''',
+                          (parsed['upload']['sha256'], parsed['month'], parsed['upload']['filename']))
+        _refresh_expense_anomalies(c)
         conn.commit()
+    return summaries
+
+def find_processed_upload(sha256):
+    """Retorna o registro do arquivo se ele for o aplicado por último ao seu mês (e o mês ainda existir)."""
+    row = get_db_connection().execute('''SELECT uploads.* FROM uploads
+                                          JOIN totals ON totals.month = uploads.month
+                                          WHERE uploads.sha256 = ?''', (sha256,)).fetchone()
+    return dict(row) if row else None
+
+def get_partners():
+    """Retorna os sócios na ordem de exibição: [{id, name, share, position, active}]."""
+    rows = get_db_connection().execute('SELECT * FROM partners ORDER BY position').fetchall()
+    return [dict(row) for row in rows]
 
-def save_processed_excel_data(month, totals_data, expenses_data, withdrawals_data):
-    """Salva todos os dados processados de um arquivo Excel de forma transacional."""
+def save_partner(name, share, active=True):
+    """Cadastra um sócio ou altera a participação/situação de um existente.
+
+    A participação vale para todos os meses (o saldo é calculado na leitura),
+    então todas as versões são incrementadas.
+    """
+    if not 0 <= share <= 1:
+        raise ValueError('A participação deve estar entre 0 e 1.')
     with get_db_connection() as conn:
         c = conn.cursor()
-        # Limpa dados antigos do mês para evitar duplicatas
-        c.execute('DELETE FROM expenses WHERE month = ?', (month,))
-        c.execute('DELETE FROM totals WHERE month = ?', (month,))
-        c.execute('DELETE FROM withdrawals WHERE month = ? AND source = ?', (month, 'excel'))
-
-        # Insere os novos totais
-        c.execute('''INSERT INTO totals (month, total_revenue, total_expenses, total_fees, net_profit, 
-                     profit_margin, share_lucas, share_thiago, share_ronaldo, share_reserva)
-                     VALUES (:month, :total_revenue, :total_expenses, :total_fees, :net_profit, 
-                     :profit_margin, :share_lucas, :share_thiago, :share_ronaldo, :share_reserva)''', 
-                     totals_data)
-
-        # Insere as despesas e retiradas em lote (mais eficiente)
-        c.executemany('INSERT INTO expenses (month, category, subcategory, amount) VALUES (?, ?, ?, ?)', expenses_data)
-        c.executemany('INSERT INTO withdrawals (month, person, amount, source) VALUES (?, ?, ?, ?)', withdrawals_data)
-        
+        c.execute('''INSERT INTO partners (name, share, position, active)
+                     VALUES (?, ?, (SELECT COALESCE(MAX(position) + 1, 0) FROM partners), ?)
+                     ON CONFLICT (name) DO UPDATE SET share = excluded.share, active = excluded.active''',
+                  (name, share, int(active)))
+        for row in c.execute('SELECT month FROM totals').fetchall():
+            _bump_data_version(c, row['month'])
         conn.commit()
 
-def add_manual_withdrawal(month, person, amount):
-    """Adiciona uma retirada manual e atualiza os totais correspondentes."""
+def add_withdrawals(entries, source='manual'):
+    """Lança várias retiradas [(mês, sócio, valor)] no livro em uma única transação.
+
+    Valida todas antes de gravar: mês importado, sócio ativo e valor positivo. Levanta
+    ValueError (nada é gravado) se alguma for inválida; retorna quantas foram lançadas.
+    """
     with get_db_connection() as conn:
         c = conn.cursor()
-        c.execute("INSERT INTO withdrawals (month, person, amount, source) VALUES (?, ?, ?, ?)",
-                  (month, person, amount, 'manual'))
-        
-        # Retiradas manuais afetam apenas a distribuição do lucro, não o lucro líquido principal
-        share_column = f"share_{person.lower()}"
-        c.execute(f"UPDATE totals SET {share_column} = {share_column} - ? WHERE month = ?", (amount, month))
-        
+        partners = {row['name']: row['id'] for row in c.execute('SELECT id, name FROM partners WHERE active = 1')}
+        months = {row['month'] for row in c.execute(DASHBOARD_QUERIES['months'])}
+        rows = []
+        for position, (month, partner, amount) in enumerate(entries, start=1):
+            if month not in months:
+                raise ValueError(f'Linha {position}: mês não importado: {month}.')
+            if partner not in partners:
+                raise ValueError(f'Linha {position}: sócio desconhecido ou inativo: {partner}.')
+            if not 0 < amount < float('inf'):
+                raise ValueError(f'Linha {position}: o valor da retirada deve ser positivo.')
+            rows.append((month, partners[partner], amount, source))
+        c.executemany('INSERT INTO withdrawal_ledger (month, partner_id, amount, source) VALUES (?, ?, ?, ?)', rows)
+        for month in sorted({row[0] for row in rows}):
+            _bump_data_version(c, month)
         conn.commit()
+    return len(rows)
+
+def add_manual_withdrawal(month, person, amount):
+    """Adiciona uma retirada manual ao livro."""
+    add_withdrawals([(month, person, amount)])
 
-def delete_manual_withdrawal(withdrawal_id):
-    """Deleta uma retirada manual e reverte as alterações nos totais."""
+def reverse_withdrawal(withdrawal_id):
+    """Estorna uma retirada lançando o valor oposto no livro (nada é apagado)."""
     with get_db_connection() as conn:
         c = conn.cursor()
-        withdrawal = c.execute("SELECT * FROM withdrawals WHERE id = ?", (withdrawal_id,)).fetchone()
-        
-        if withdrawal:
-            amount = withdrawal['amount']
-            month = withdrawal['month']
-            person = withdrawal['person']
-            
-            c.execute("DELETE FROM withdrawals WHERE id = ?", (withdrawal_id,))
-            
-            # Reverte a alteração na distribuição do lucro
-            share_column = f"share_{person.lower()}"
-            c.execute(f"UPDATE totals SET {share_column} = {share_column} + ? WHERE month = ?", (amount, month))
-            
-            conn.commit()
-            return True, ""
-    return False, "Retirada não encontrada."
+        withdrawal = c.execute('''SELECT w.*, r.id AS reversed_by FROM withdrawal_ledger w
+                                  LEFT JOIN withdrawal_ledger r ON r.reverses_id = w.id
+                                  WHERE w.id = ?''', (withdrawal_id,)).fetchone()
+        if not withdrawal:
+            return False, "Retirada não encontrada."
+        if withdrawal['reverses_id'] is not None:
+            return False, "Um estorno não pode ser estornado."
+        if withdrawal['reversed_by'] is not None:
+            return False, "Esta retirada já foi estornada."
+
+        try:
+            c.execute('''INSERT INTO withdrawal_ledger (month, partner_id, amount, source, reverses_id)
+                         VALUES (?, ?, ?, 'estorno', ?)''',
+                      (withdrawal['month'], withdrawal['partner_id'], -withdrawal['amount'], withdrawal_id))
+        except sqlite3.IntegrityError:
+            # reverses_id é UNIQUE: outro pedido estornou a mesma retirada antes deste
+            conn.rollback()
+            return False, "Esta retirada já foi estornada."
+        _bump_data_version(c, withdrawal['month'])
+        conn.commit()
+        return True, ""
 
 def get_dashboard_data(selected_month):
-    """Busca todos os dados necessários para renderizar o dashboard de um mês."""
+    """Busca todos os dados necessários para renderizar o dashboard de um mês (com cache)."""
+    if not selected_month:
+        return _build_dashboard_data(selected_month)
+    # A versão é lida antes dos dados: uma escrita concorrente só pode deixar o cache mais novo
+    version = get_data_versions([selected_month])
+    return _cached(('dashboard', selected_month), version,
+                   lambda: _build_dashboard_data(selected_month))
+
+def _build_dashboard_data(selected_month):
     data = {
         "totals": None, "expenses": {}, "revenue_in_mw": 0,
         "top_10_chart_data": None, "withdrawals_list": [], 
-        "fees_in_mw": 0
+        "fees_in_mw": 0, "anomalies": [], "partners": []
     }
     if not selected_month:
         return data
@@ -98,53 +910,37 @@ def get_dashboard_data(selected_month):
         c = conn.cursor()
         
         # Totais e cálculo de Salário Mínimo
-        totals_row = c.execute('SELECT * FROM totals WHERE month = ?', (selected_month,)).fetchone()
+        totals_row = c.execute(DASHBOARD_QUERIES['totals'], (selected_month,)).fetchone()
         if totals_row:
             data['totals'] = dict(totals_row)
             if data['totals'].get('total_revenue', 0) > 0:
                 data['revenue_in_mw'] = data['totals']['total_revenue'] / 1518.0
 
-        if data['totals'].get('total_fees', 0) > 0:
+        if data['totals'] and data['totals'].get('total_fees', 0) > 0:
             data['fees_in_mw'] = data['totals']['total_fees'] / 1518.0
 
         # Top 10 Despesas - EXCLUINDO Reembolsos a Clientes
-        top_10_rows = c.execute('''
-            SELECT subcategory, amount 
-            FROM expenses 
-            WHERE month = ? AND category != 'Reembolsos a Clientes'
-            ORDER BY amount DESC 
-            LIMIT 10
-        ''', (selected_month,)).fetchall()
+        top_10_rows = c.execute(DASHBOARD_QUERIES['top_10'], (selected_month,)).fetchall()
         if top_10_rows:
             data['top_10_chart_data'] = {
                 'labels': [row['subcategory'] for row in top_10_rows],
                 'data': [row['amount'] for row in top_10_rows]
             }
         
-        # ORDEM FIXA DAS CATEGORIAS
-        category_order = [
-            'Despesas com Pessoal',
-            'Impostos e Encargos',
-            'Despesas de Escritório',
-            'Mensalidades e Serviços',
-            'Manutenção e Investimentos',
-            'Reembolsos a Clientes',
-            'Outras Despesas'
-        ]
+        # Ordem das categorias definida na tabela categories
+        category_order = get_category_order()
         
         # Inicializa todas as categorias na ordem correta (mesmo vazias)
         for category in category_order:
             data['expenses'][category] = []
         
-        # Despesas detalhadas com percentual
-        expense_rows = c.execute('SELECT category, subcategory, amount FROM expenses WHERE month = ?', (selected_month,)).fetchall()
-        category_totals = defaultdict(float)
-        for row in expense_rows:
-            category_totals[row['category']] += row['amount']
-        
+        # Despesas detalhadas com percentual (totais por categoria já materializados)
+        category_totals = {row['category']: row['total'] for row in
+                           c.execute(DASHBOARD_QUERIES['category_totals'], (selected_month,))}
+        expense_rows = c.execute(DASHBOARD_QUERIES['expenses'], (selected_month,)).fetchall()
         for row in expense_rows:
             category, amount = row['category'], row['amount']
-            total = category_totals[category]
+            total = category_totals.get(category, 0)
             percentage = (amount / total * 100) if total > 0 else 0
             if category in data['expenses']:  # Só adiciona se a categoria existir na ordem
                 data['expenses'][category].append({'subcategory': row['subcategory'], 'amount': amount, 'percentage': percentage})
@@ -152,16 +948,33 @@ def get_dashboard_data(selected_month):
         # Remove categorias vazias
         data['expenses'] = {k: v for k, v in data['expenses'].items() if v}
 
-        # Lista de Retiradas
-        data['withdrawals_list'] = c.execute('SELECT * FROM withdrawals WHERE month = ? ORDER BY timestamp DESC', (selected_month,)).fetchall()
+        # Livro de retiradas do mês e saldo de cada sócio (participação no lucro - retiradas)
+        data['withdrawals_list'] = [dict(row) for row in c.execute(DASHBOARD_QUERIES['withdrawals'], (selected_month,))]
+        withdrawn = dict(c.execute(DASHBOARD_QUERIES['partner_balances'], (selected_month,)).fetchall())
+        net_profit = (data['totals'] or {}).get('net_profit') or 0
+        for partner in c.execute(DASHBOARD_QUERIES['partners']):
+            if not partner['active'] and partner['id'] not in withdrawn:
+                continue
+            profit_share = net_profit * partner['share']
+            data['partners'].append({
+                'name': partner['name'], 'share': partner['share'], 'profit_share': profit_share,
+                'withdrawn': withdrawn.get(partner['id'], 0), 'balance': profit_share - withdrawn.get(partner['id'], 0)
+            })
+
+        # Alertas de picos de gasto (expense_anomalies, recalculada a cada importação)
+        data['anomalies'] = [dict(row) for row in c.execute(DASHBOARD_QUERIES['anomalies'], (selected_month,))]
         
     return data
 
 def get_available_months():
-    """Busca a lista de meses disponíveis."""
+    """Busca a lista de meses disponíveis (com cache)."""
+    version = get_data_versions([ALL_MONTHS_SCOPE])
+    return _cached(('months',), version, _build_available_months)
+
+def _build_available_months():
     with get_db_connection() as conn:
         c = conn.cursor()
-        c.execute('SELECT DISTINCT month FROM totals ORDER BY month DESC')
+        c.execute(DASHBOARD_QUERIES['months'])
         return [row['month'] for row in c.fetchall()]
 
 def delete_all_month_data(month):
@@ -170,25 +983,59 @@ def delete_all_month_data(month):
         c = conn.cursor()
         c.execute('DELETE FROM expenses WHERE month = ?', (month,))
         c.execute('DELETE FROM totals WHERE month = ?', (month,))
-        c.execute('DELETE FROM withdrawals WHERE month = ?', (month,))
+        c.execute('DELETE FROM uploads WHERE month = ?', (month,))
+        _refresh_month_aggregates(c, month)
+        _refresh_expense_anomalies(c)
+        _bump_data_version(c, month)
         conn.commit()
         
+def get_category_map():
+    """Retorna {subcategoria: categoria} na ordem de exibição, para a categorização do Excel."""
+    rows = get_db_connection().execute(
+        'SELECT subcategory, category FROM categories ORDER BY position').fetchall()
+    return {row['subcategory']: row['category'] for row in rows}
+
+def get_category_order():
+    """Lista as categorias na ordem de exibição do dashboard."""
+    rows = get_db_connection().execute(
+        'SELECT category FROM categories GROUP BY category ORDER BY MIN(position)').fetchall()
+    return [row['category'] for row in rows]
+
+def set_category(subcategory, category):
+    """Cria ou altera o mapeamento de uma subcategoria (vale para os próximos envios)."""
+    with get_db_connection() as conn:
+        conn.execute('''INSERT INTO categories (subcategory, category, position)
+                        VALUES (?, ?, (SELECT COALESCE(MAX(position), -1) + 1 FROM categories))
+                        ON CONFLICT (subcategory) DO UPDATE SET category = excluded.category''',
+                     (subcategory, category))
+        # A ordem das categorias no dashboard pode mudar: invalida todos os caches
+        conn.execute('UPDATE data_versions SET version = version + 1')
+        # Um reenvio do mesmo arquivo precisa ser lido de novo para pegar a nova categorização
+        conn.execute('DELETE FROM uploads')
+        conn.commit()
+
 # Adicione esta função ao final do seu arquivo database.py
 
 def get_compare_data(selected_months):
-    """Busca e prepara os dados para a página de comparação de meses."""
+    """Busca e prepara os dados para a página de comparação de meses (com cache)."""
+    months = tuple(selected_months)
+    version = get_data_versions(months)
+    return _cached(('compare', months), version,
+                   lambda: _build_compare_data(list(months)))
+
+def _build_compare_data(selected_months):
     with get_db_connection() as conn:
         placeholders = ','.join('?' for _ in selected_months)
         
         # 1. Buscar dados da tabela 'totals'
         totals_data_rows = conn.execute(
-            f"SELECT * FROM totals WHERE month IN ({placeholders}) ORDER BY month", 
+            DASHBOARD_QUERIES['compare_totals'].format(placeholders=placeholders),
             selected_months
         ).fetchall()
 
         # 2. Buscar e agregar despesas por categoria
         expenses_data_rows = conn.execute(
-            f"SELECT month, category, SUM(amount) as total FROM expenses WHERE month IN ({placeholders}) GROUP BY month, category ORDER BY month", 
+            DASHBOARD_QUERIES['compare_categories'].format(placeholders=placeholders),
             selected_months
         ).fetchall()
 
@@ -207,8 +1054,9 @@ def get_compare_data(selected_months):
     category_comparison_data = defaultdict(lambda: [0] * len(selected_months))
     category_totals_for_sorting = defaultdict(float)
 
+    month_positions = {month: index for index, month in enumerate(selected_months)}
     for row in expenses_data_rows:
-        month_index = selected_months.index(row['month'])
+        month_index = month_positions[row['month']]
         category_comparison_data[row['category']][month_index] = row['total']
         category_totals_for_sorting[row['category']] += row['total']
     
@@ -219,4 +1067,408 @@ def get_compare_data(selected_months):
         'datasets': [{'label': cat, 'data': category_comparison_data[cat]} for cat in sorted_categories]
     }
     
-    return totals_comparison, category_comparison
\ No newline at end of file
+    return totals_comparison, category_comparison
+
+# Visão consolidada: totais de todos os escritórios, consultados em paralelo
+CONSOLIDATED_WORKERS = int(os.environ.get('CONSOLIDATED_WORKERS', 8))
+CONSOLIDATED_DEFAULT_MONTHS = 12
+CONSOLIDATED_METRICS = ('total_revenue', 'total_expenses', 'total_fees', 'net_profit')
+
+_tenant_executor = None
+_tenant_executor_lock = threading.Lock()
+
+def _get_tenant_executor():
+    # Criado no primeiro uso: threads iniciadas no processo mestre não sobrevivem ao fork dos workers
+    global _tenant_executor
+    with _tenant_executor_lock:
+        if _tenant_executor is None:
+            _tenant_executor = ThreadPoolExecutor(max_workers=CONSOLIDATED_WORKERS,
+                                                  thread_name_prefix='tenants')
+        return _tenant_executor
+
+def run_in_tenant(tenant, fn, *args):
+    """Roda fn(*args) no banco do escritório (None = banco principal) e devolve a conexão ao final."""
+    token = current_tenant.set(tenant)
+    try:
+        return fn(*args)
+    finally:
+        close_db_connection()
+        current_tenant.reset(token)
+
+def map_tenants(fn, *args, tenants=None):
+    """Roda fn(*args) no banco de cada escritório, em paralelo.
+
+    Retorna {escritório: (resultado, erro)}; a falha de um escritório não
+    interrompe os demais.
+    """
+    tenants = list_tenants() if tenants is None else tenants
+    futures = {tenant: _get_tenant_executor().submit(run_in_tenant, tenant, fn, *args) for tenant in tenants}
+    results = {}
+    for tenant, future in futures.items():
+        try:
+            results[tenant] = (future.result(), None)
+        except Exception as e:
+            logger.exception("Falha ao consultar o escritório %s", tenant)
+            results[tenant] = (None, str(e))
+    return results
+
+def _get_tenant_totals(months):
+    version = get_data_versions(months)
+    return _cached(('consolidated', months), version, lambda: _build_tenant_totals(months))
+
+def _build_tenant_totals(months):
+    placeholders = ','.join('?' for _ in months)
+    rows = get_db_connection().execute(DASHBOARD_QUERIES['compare_totals'].format(placeholders=placeholders),
+                                       months).fetchall()
+    return {row['month']: {metric: row[metric] or 0 for metric in CONSOLIDATED_METRICS} for row in rows}
+
+def _summarize_totals(totals_by_month):
+    summary = {metric: sum(totals[metric] for totals in totals_by_month) for metric in CONSOLIDATED_METRICS}
+    revenue = summary['total_revenue']
+    summary['profit_margin'] = (summary['net_profit'] / revenue * 100) if revenue > 0 else 0
+    return summary
+
+def get_consolidated_data(selected_months=None):
+    """Compara os totais de todos os escritórios nos meses escolhidos (padrão: os 12 mais recentes).
+
+    Cada escritório é consultado em uma thread, usando o cache e a conexão do
+    pool do seu próprio banco.
+    """
+    available = set()
+    errors = {}
+    for tenant, (months, error) in map_tenants(get_available_months).items():
+        available.update(months or [])
+        if error:
+            errors[tenant] = error
+    available_months = sorted(available, reverse=True)
+    months = tuple(sorted(selected_months or available_months[:CONSOLIDATED_DEFAULT_MONTHS]))
+
+    tenants = []
+    if months:
+        for tenant, (totals, error) in map_tenants(_get_tenant_totals, months).items():
+            totals = totals or {}
+            tenants.append({
+                'tenant': tenant, 'error': errors.get(tenant) or error, 'totals': totals,
+                'summary': _summarize_totals(totals.values()),
+            })
+    return {
+        'months': list(months),
+        'available_months': available_months,
+        'tenants': tenants,
+        'overall': _summarize_totals([tenant['summary'] for tenant in tenants]),
+        'chart': {
+            'labels': list(months),
+            'datasets': [{'label': tenant['tenant'],
+                          'data': [tenant['totals'].get(month, {}).get('net_profit', 0) for month in months]}
+                         for tenant in tenants],
+        },
+    }
+
+# Séries da análise de tendência: métricas da tabela totals e colunas calculadas
+TREND_METRICS = ('total_revenue', 'total_expenses', 'total_fees', 'net_profit')
+TREND_SERIES = ('value', 'avg_3', 'avg_12', 'ytd', 'mom_delta', 'yoy_delta')
+
+# Janelas sobre o índice do mês (ano * 12 + mês): RANGE considera meses ausentes,
+# então "mês anterior" e "mesmo mês do ano anterior" ficam NULL quando não existem.
+_TREND_WINDOWS = '''
+    WINDOW last_3 AS (PARTITION BY {partition} ORDER BY month_index RANGE BETWEEN 2 PRECEDING AND CURRENT ROW),
+           last_12 AS (PARTITION BY {partition} ORDER BY month_index RANGE BETWEEN 11 PRECEDING AND CURRENT ROW),
+           ytd AS (PARTITION BY {partition}, year ORDER BY month_index ROWS UNBOUNDED PRECEDING),
+           prev_month AS (PARTITION BY {partition} ORDER BY month_index RANGE BETWEEN 1 PRECEDING AND 1 PRECEDING),
+           prev_year AS (PARTITION BY {partition} ORDER BY month_index RANGE BETWEEN 12 PRECEDING AND 12 PRECEDING)
+'''
+
+_MONTH_INDEX_SQL = "CAST(substr(month, 1, 4) AS INTEGER) * 12 + CAST(substr(month, 6, 2) AS INTEGER)"
+
+def _trend_columns(value, prefix):
+    """Colunas de janela (médias móveis, acumulado do ano, variações) de uma métrica."""
+    return f'''{value} AS {prefix}value,
+        AVG({value}) OVER last_3 AS {prefix}avg_3,
+        AVG({value}) OVER last_12 AS {prefix}avg_12,
+        SUM({value}) OVER ytd AS {prefix}ytd,
+        {value} - SUM({value}) OVER prev_month AS {prefix}mom_delta,
+        {value} - SUM({value}) OVER prev_year AS {prefix}yoy_delta'''
+
+TREND_QUERIES = {
+    'totals': f'''
+        WITH series AS (
+            SELECT month, {_MONTH_INDEX_SQL} AS month_index, substr(month, 1, 4) AS year,
+                   {', '.join(TREND_METRICS)}, 0 AS grp
+            FROM totals
+        ),
+        windowed AS (
+            SELECT month, {', '.join(_trend_columns(metric, metric + '__') for metric in TREND_METRICS)}
+            FROM series
+            {_TREND_WINDOWS.format(partition='grp')}
+        )
+        SELECT * FROM windowed WHERE month BETWEEN ? AND ? ORDER BY month
+    ''',
+    'categories': f'''
+        WITH calendar AS (
+            SELECT month, {_MONTH_INDEX_SQL} AS month_index, substr(month, 1, 4) AS year FROM totals
+        ),
+        series AS (
+            SELECT calendar.month, calendar.month_index, calendar.year, names.category,
+                   COALESCE(category_totals.total, 0) AS total
+            FROM calendar
+            CROSS JOIN (SELECT DISTINCT category FROM category_totals) AS names
+            LEFT JOIN category_totals
+                   ON category_totals.month = calendar.month AND category_totals.category = names.category
+        ),
+        windowed AS (
+            SELECT month, category, {_trend_columns('total', '')}
+            FROM series
+            {_TREND_WINDOWS.format(partition='category')}
+        )
+        SELECT * FROM windowed WHERE month BETWEEN ? AND ? ORDER BY category, month
+    ''',
+}
+
+def get_trend_data(start_month=None, end_month=None):
+    """Série histórica com médias móveis de 3/12 meses, acumulado do ano e variações
+    mês a mês e ano a ano, para os totais e para cada categoria (com cache).
+
+    As janelas são calculadas pelo SQLite sobre todo o histórico e só depois
+    filtradas pelo intervalo, então as médias do início do período consideram
+    os meses anteriores a ele.
+    """
+    start_month = start_month or '0000-00'
+    end_month = end_month or '9999-99'
+    version = get_data_versions([ALL_MONTHS_SCOPE])
+    return _cached(('trends', start_month, end_month), version,
+                   lambda: _build_trend_data(start_month, end_month))
+
+def _build_trend_data(start_month, end_month):
+    conn = get_db_connection()
+    totals_rows = conn.execute(TREND_QUERIES['totals'], (start_month, end_month)).fetchall()
+    category_rows = conn.execute(TREND_QUERIES['categories'], (start_month, end_month)).fetchall()
+
+    trend = {
+        'labels': [row['month'] for row in totals_rows],
+        'metrics': {
+            metric: {series: [row[f'{metric}__{series}'] for row in totals_rows] for series in TREND_SERIES}
+            for metric in TREND_METRICS
+        },
+        'categories': {},
+    }
+    for row in category_rows:
+        series_by_name = trend['categories'].setdefault(
+            row['category'], {series: [] for series in TREND_SERIES})
+        for series in TREND_SERIES:
+            series_by_name[series].append(row[series])
+    return trend
+
+# Busca textual: o texto digitado vira prefixos entre aspas, sem expor a sintaxe do FTS5
+SEARCH_PER_PAGE = 20
+SEARCH_MAX_PER_PAGE = 100
+SEARCH_QUERY = '''
+    WITH hits AS MATERIALIZED (
+        SELECT rowid AS id, bm25(expense_search, 2.0, 1.0) AS score
+        FROM expense_search WHERE expense_search MATCH ?
+    )
+    SELECT s.category, s.subcategory, s.month, s.total, s.entries, hits.score
+    FROM hits JOIN subcategory_totals s ON s.id = hits.id
+    ORDER BY s.month
+'''
+
+def build_match_query(text):
+    """Converte o texto digitado em uma consulta FTS5 segura: todos os termos, por prefixo."""
+    return ' '.join('"{}"*'.format(term.replace('"', '""')) for term in text.split())
+
+def search_expenses(text, page=1, per_page=SEARCH_PER_PAGE):
+    """Busca descrições de despesas em todos os meses (com cache).
+
+    Os resultados são agrupados por (categoria, subcategoria), ordenados por
+    relevância (bm25) e depois pelo total, e paginados; cada um traz o valor
+    por mês e o total. A resposta inclui o total geral de todas as páginas.
+    """
+    match_query = build_match_query(text or '')
+    per_page = max(1, min(per_page, SEARCH_MAX_PER_PAGE))
+    page = max(1, page)
+    results = []
+    if match_query:
+        version = get_data_versions([ALL_MONTHS_SCOPE])
+        results = _cached(('search', match_query), version,
+                          lambda: _build_search_results(match_query))
+    return {
+        'query': text or '',
+        'page': page,
+        'per_page': per_page,
+        'pages': (len(results) + per_page - 1) // per_page,
+        'total_results': len(results),
+        'grand_total': sum(result['total'] for result in results),
+        'entries': sum(result['entries'] for result in results),
+        'results': results[(page - 1) * per_page:page * per_page],
+    }
+
+def _build_search_results(match_query):
+    conn = get_db_connection()
+    grouped = {}
+    for row in conn.execute(SEARCH_QUERY, (match_query,)):
+        result = grouped.setdefault((row['category'], row['subcategory']), {
+            'category': row['category'], 'subcategory': row['subcategory'],
+            'score': row['score'], 'total': 0.0, 'entries': 0, 'months': [],
+        })
+        result['score'] = min(result['score'], row['score'])
+        result['total'] += row['total']
+        result['entries'] += row['entries']
+        result['months'].append({'month': row['month'], 'total': row['total'], 'entries': row['entries']})
+    # bm25 é negativo: quanto menor, mais relevante
+    return sorted(grouped.values(), key=lambda result: (result['score'], -result['total']))
+
+# Exportação: colunas (nome, tipo) de cada tabela, na ordem dos arquivos gerados
+EXPORT_COLUMNS = {
+    'totals': (('month', 'text'), ('total_revenue', 'real'), ('total_expenses', 'real'),
+               ('total_fees', 'real'), ('net_profit', 'real'), ('profit_margin', 'real')),
+    'expenses': (('month', 'text'), ('category', 'text'), ('subcategory', 'text'), ('amount', 'real')),
+    'withdrawals': (('id', 'integer'), ('month', 'text'), ('partner', 'text'), ('amount', 'real'),
+                    ('source', 'text'), ('reverses_id', 'integer'), ('created_at', 'text')),
+}
+# Origem de cada exportação (FROM ... WHERE mês BETWEEN ? AND ?) e ordenação coberta
+# pelos índices por mês, para o SQLite não precisar ordenar tudo antes da primeira linha
+EXPORT_SOURCES = {
+    'totals': ('totals', 'month', 'month'),
+    'expenses': ('expenses', 'month', 'month, category, amount'),
+    'withdrawals': ('withdrawal_ledger JOIN partners ON partners.id = withdrawal_ledger.partner_id',
+                    'withdrawal_ledger.month', 'withdrawal_ledger.month, withdrawal_ledger.id'),
+}
+# Colunas de EXPORT_COLUMNS que não têm o mesmo nome na origem
+EXPORT_EXPRESSIONS = {
+    'withdrawals': {'id': 'withdrawal_ledger.id', 'month': 'withdrawal_ledger.month', 'partner': 'partners.name'},
+}
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 5000))
+
+def iter_export_batches(table, start_month=None, end_month=None, batch_size=EXPORT_BATCH_SIZE):
+    """Gera lotes de linhas (tuplas) da tabela no período, sem carregar tudo em memória.
+
+    Usa uma conexão própria, fechada quando o gerador termina ou é descartado,
+    e lê o cursor com fetchmany em vez de fetchall. O banco é migrado antes,
+    como em get_db_connection: a exportação pode ser o primeiro acesso do
+    processo a ele.
+    """
+    expressions = EXPORT_EXPRESSIONS.get(table, {})
+    columns = ', '.join(expressions.get(name, name) for name, _ in EXPORT_COLUMNS[table])
+    source, month_column, order = EXPORT_SOURCES[table]
+    sql = f'SELECT {columns} FROM {source} WHERE {month_column} BETWEEN ? AND ? ORDER BY {order}'
+    ensure_schema()
+    conn = _connect()
+    conn.row_factory = None
+    try:
+        cursor = conn.execute(sql, (start_month or '0000-00', end_month or '9999-99'))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield rows
+    finally:
+        conn.close()
+
+def create_ingest_job(filename, spool_files=()):
+    """Registra um novo job de importação na fila e retorna o seu id.
+
+    `spool_files` são os arquivos temporários que o job vai ler; ficam
+    registrados até o job terminar, para que os de um job abandonado possam
+    ser apagados (take_abandoned_spool_files).
+    """
+    job_id = uuid.uuid4().hex
+    spool_json = json.dumps(list(spool_files)) if spool_files else None
+    with get_db_connection() as conn:
+        conn.execute("INSERT INTO ingest_jobs (id, filename, status, spool_files) VALUES (?, ?, 'queued', ?)",
+                     (job_id, filename, spool_json))
+        conn.commit()
+    return job_id
+
+def update_ingest_job(job_id, status, month=None, message=None, report=None):
+    """Atualiza o status (queued/running/done/failed) de um job de importação.
+
+    Só um job ainda em andamento muda de status: um job já marcado como falho
+    (abandonado, ver get_ingest_job) não volta a aparecer como concluído.
+    Retorna se o job foi atualizado.
+    """
+    report_json = json.dumps(report, ensure_ascii=False) if report is not None else None
+    with get_db_connection() as conn:
+        cursor = conn.execute('''UPDATE ingest_jobs SET status = ?, month = COALESCE(?, month),
+                                 message = COALESCE(?, message), report = COALESCE(?, report),
+                                 spool_files = CASE WHEN ? IN ('done', 'failed') THEN NULL ELSE spool_files END,
+                                 updated_at = CURRENT_TIMESTAMP
+                                 WHERE id = ? AND status IN ('queued', 'running')''',
+                              (status, month, message, report_json, status, job_id))
+        conn.commit()
+    return cursor.rowcount > 0
+
+def touch_ingest_job(job_id):
+    """Sinal de vida de um job em execução; retorna False se ele já foi dado como abandonado."""
+    with get_db_connection() as conn:
+        cursor = conn.execute("UPDATE ingest_jobs SET updated_at = CURRENT_TIMESTAMP WHERE id = ? AND status = 'running'",
+                              (job_id,))
+        conn.commit()
+    return cursor.rowcount > 0
+
+def take_abandoned_spool_files():
+    """Arquivos temporários de jobs já encerrados que não os liberaram (abandonados).
+
+    Os caminhos deixam de ser registrados; quem chama apaga os arquivos.
+    """
+    with get_db_connection() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        rows = conn.execute('''SELECT id, spool_files FROM ingest_jobs
+                               WHERE spool_files IS NOT NULL AND status IN ('done', 'failed')''').fetchall()
+        conn.executemany('UPDATE ingest_jobs SET spool_files = NULL WHERE id = ?', [(row['id'],) for row in rows])
+        conn.commit()
+    return [path for row in rows for path in json.loads(row['spool_files'])]
+
+# Um job queued/running sem atualização por mais tempo que isso ficou órfão (worker
+# reiniciado ou encerrado no meio) e passa a constar como falho; os lotes dão sinal
+# de vida (touch_ingest_job) a cada arquivo lido
+INGEST_JOB_TIMEOUT = int(os.environ.get('INGEST_JOB_TIMEOUT', 1800))  # segundos
+
+def fail_stale_ingest_jobs(max_age=INGEST_JOB_TIMEOUT, message=None):
+    """Marca como falhos os jobs queued/running parados há mais de `max_age` segundos (None = todos).
+
+    Chamada sem idade no início do servidor (gunicorn.conf.py), quando nenhum job
+    pode estar rodando. Retorna quantos jobs foram marcados.
+    """
+    message = message or 'A importação foi interrompida antes de terminar; envie o arquivo novamente.'
+    with get_db_connection() as conn:
+        cursor = conn.execute('''UPDATE ingest_jobs SET status = 'failed', message = ?, updated_at = CURRENT_TIMESTAMP
+                                 WHERE status IN ('queued', 'running')
+                                 AND (? IS NULL OR updated_at < datetime('now', ?))''',
+                              (message, max_age, f'-{max_age or 0:d} seconds'))
+        conn.commit()
+    return cursor.rowcount
+
+def get_ingest_job(job_id):
+    """Busca um job de importação pelo id (jobs órfãos há mais de INGEST_JOB_TIMEOUT voltam como falhos)."""
+    with get_db_connection() as conn:
+        row = conn.execute('''SELECT *, (julianday('now') - julianday(updated_at)) * 86400 AS idle_seconds
+                              FROM ingest_jobs WHERE id = ?''', (job_id,)).fetchone()
+        if row and row['status'] in ('queued', 'running') and row['idle_seconds'] > INGEST_JOB_TIMEOUT:
+            conn.execute('''UPDATE ingest_jobs SET status = 'failed', message = ?, updated_at = CURRENT_TIMESTAMP
+                            WHERE id = ? AND status IN ('queued', 'running')''',
+                         ('A importação foi interrompida antes de terminar; envie o arquivo novamente.', job_id))
+            conn.commit()
+            row = conn.execute('SELECT * FROM ingest_jobs WHERE id = ?', (job_id,)).fetchone()
+    if not row:
+        return None
+    job = dict(row)
+    job.pop('idle_seconds', None)
+    job['report'] = json.loads(job['report']) if job['report'] else None
+    return job
+
+if __name__ == '__main__':
+    import sys
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'migrate'
+    if command == 'migrate':
+        print(f"Esquema na versão {init_db()} ({DATABASE})")
+    elif command == 'explain':
+        init_db()
+        ok = True
+        for name, (uses_index, plan) in check_query_plans().items():
+            ok = ok and uses_index
+            print(f"[{'OK' if uses_index else 'FALHA'}] {name}")
+            for detail in plan:
+                print(f"    {detail}")
+        sys.exit(0 if ok else 1)
+    else:
+        sys.exit("Uso: python database.py [migrate|explain]")
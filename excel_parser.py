@@ -0,0 +1,398 @@
+import logging
+import math
+import re
+import time
+import unicodedata
+from datetime import datetime
+
+import metrics
+
+# openpyxl e pandas são importados dentro das funções de leitura: só quem
+# importa planilhas paga o custo (tempo e memória) de carregá-los
+
+logger = logging.getLogger(__name__)
+
+SHEET_NAME = 'Página 1'
+PERIOD_PATTERN = re.compile(r'(\d{2}/\d{2}/\d{4})\s*à\s*(\d{2}/\d{2}/\d{4})')
+LABEL_COLUMN = 10  # Coluna K: "Receitas:" / "Despesas:"
+VALUE_COLUMN = 11  # Coluna L: valores dos totais
+PARSE_PHASE_METRIC = 'contajur_parse_phase_duration_seconds'
+
+# Categorização de despesas com GRUPOS
+CATEGORIES = {
+    'Despesas com Pessoal': [
+        'Salários',
+        '13° Salário',
+        'Férias',
+        'Vale transporte',
+        'Vale alimentação',
+        'Plano de Saude',
+        'Plano Odontologico',
+        'Aniversário colaboradores',
+        'Seguro de vida',
+        'Feira, Mercado e outros',
+        'SST',
+        'Cursos e Palestras'
+    ],
+    'Impostos e Encargos': [
+        'DAS - CONTAJUR',
+        'FGTS - CONTAJUR',
+        'DARF Previdenciário - Contajur'
+    ],
+    'Despesas de Escritório': [
+        'Luz',
+        'Telefonia',
+        'Internet',
+        'Aluguel',
+        'Materiais de limpeza',
+        'Uniformes',
+        'Material de escritório',
+        'Material de uso e consumo',
+        'Segurança'
+    ],
+    'Mensalidades e Serviços': [
+        'Mensalidade de Sistema',
+        'Mensalidade T.I.',
+        'Mensalidade Marketing Digital',
+        'Mensalidade Revista Tecnica',
+        'Mensalidade Aluguel de Impressora',
+        'Mensalidade Associal Comercial',
+        'Mensalidade Manutenção Web',
+        'Implantação Sistema',
+        'Mensalidade Personal',
+        'Mensalidade Rede Cidada'
+    ],
+    'Manutenção e Investimentos': [
+        'Manutenção Contajur (pintura, reforma, etc.)',
+        'Aquisição imóvel/construção',
+        'Combustivel e Manutençao Motos'
+    ],
+    'Reembolsos a Clientes': [
+        'DAS - Reembolso Imposto Federal - Cliente',
+        'Reembolso Imposto Estadual - Cliente',
+        'Reembolso Imposto Estadual ICMS - Cliente',
+        'GPS Autonomo - Reembolso Trabalhista- Cliente',
+        'Abertura,baixa e alteração JUCEMG - Cliente',
+        'Reembolso Certificado Digital',
+        'FGTS - Reembolso trabalhista - Cliente',
+        'Esocial - Reembolso trabalhista - Cliente',
+        'Contrib Sindical - Reembolso trabalhista - cliente',
+        'DARF - Retenção NF - Cliente',
+        'ISSQN - Cliente',
+        'DARF Previdenciário - Cliente',
+        'Carnê Leão - cliente',
+        'DAS Parcelamento - Reembolso de cliente'
+    ],
+    'Outras Despesas': [
+        'Outras despesas',
+        'Confraternização e Brindes fim de ano',
+        'Multa e Juros',
+        'Tarifa Bancaria'
+    ]
+}
+
+
+def build_category_map(categories):
+    """Achata {categoria: [subcategorias]} em {subcategoria: categoria}, preservando a ordem."""
+    return {subcategory: category for category, subcategories in categories.items()
+            for subcategory in subcategories}
+
+
+DEFAULT_CATEGORY_MAP = build_category_map(CATEGORIES)
+
+
+def convert_br_to_float(value):
+    """Converte valores no formato brasileiro (1.234,56) para float"""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return 0.0
+    if isinstance(value, (int, float)):
+        return float(value)
+    value_str = str(value).strip()
+    value_str = value_str.replace('.', '').replace(',', '.')
+    try:
+        return float(value_str)
+    except ValueError:
+        return 0.0
+
+
+def convert_br_series(values):
+    """Versão vetorizada de convert_br_to_float para uma coluna inteira."""
+    import pandas as pd
+
+    if pd.api.types.is_numeric_dtype(values):
+        return values.astype(float).fillna(0.0)
+    text = values.str.strip()  # NaN para células que não são texto
+    from_text = pd.to_numeric(text.str.replace('.', '', regex=False).str.replace(',', '.', regex=False),
+                              errors='coerce')
+    from_numbers = pd.to_numeric(values.where(text.isna()), errors='coerce')
+    return from_text.where(text.notna(), from_numbers).fillna(0.0).astype(float)
+
+
+def _month_from_header(first_cell):
+    """Extrai o mês (AAAA-MM) do período informado na primeira célula da planilha."""
+    date_match = PERIOD_PATTERN.search(str(first_cell))
+    if date_match:
+        return datetime.strptime(date_match.group(1), '%d/%m/%Y').strftime('%Y-%m')
+    return datetime.now().strftime('%Y-%m')
+
+
+def _is_fee_description(description):
+    """Indica se a descrição é de honorários (ignorando acentos e caixa)."""
+    normalized = unicodedata.normalize('NFKD', description.strip().lower())
+    return normalized.encode('ascii', errors='ignore').decode('utf-8').startswith('honorario')
+
+
+def _build_totals_data(month, total_revenue, total_expenses_raw, total_fees):
+    """Monta o dicionário de totais no formato esperado por db.save_processed_excel_data."""
+    # Cálculos de lucro (SEM retiradas)
+    total_expenses = total_expenses_raw
+    profit_before_withdrawals = total_revenue - total_expenses
+    net_profit = profit_before_withdrawals
+    profit_margin = (net_profit / total_revenue * 100) if total_revenue > 0 else 0
+
+    # A parte de cada sócio é calculada na leitura (tabela partners + livro de retiradas)
+    return {
+        "month": month,
+        "total_revenue": total_revenue,
+        "total_expenses": total_expenses,
+        "total_fees": total_fees,
+        "net_profit": net_profit,
+        "profit_margin": profit_margin
+    }
+
+
+def _build_result(month, totals_data, expenses_data, unmapped):
+    # Retiradas não vêm do Excel: ficam no livro de retiradas, que a importação não altera
+    return {
+        "month": month,
+        "totals_data": totals_data,
+        "expenses_data": expenses_data,
+        "unmapped": unmapped
+    }
+
+
+def _summarize_unmapped(descriptions_and_amounts):
+    """Agrupa as descrições sem categoria: [{subcategory, count, amount}], maiores primeiro."""
+    summary = {}
+    for description, amount in descriptions_and_amounts:
+        entry = summary.setdefault(description, [0, []])
+        entry[0] += 1
+        entry[1].append(amount)
+    unmapped = [{'subcategory': description, 'count': count, 'amount': math.fsum(amounts)}
+                for description, (count, amounts) in summary.items()]
+    return sorted(unmapped, key=lambda item: -abs(item['amount']))
+
+
+def _match_totals_label(row, totals_cells):
+    """Guarda o valor da coluna L na primeira linha com "Receitas:"/"Despesas:" na coluna K."""
+    if len(row) > VALUE_COLUMN:
+        label = str(row[LABEL_COLUMN]).strip()
+        if label in ('Receitas:', 'Despesas:'):
+            totals_cells.setdefault(label, row[VALUE_COLUMN])
+
+
+def _rewind(file_path):
+    """Volta ao início arquivos abertos (ex.: BytesIO), que podem ser lidos mais de uma vez."""
+    if hasattr(file_path, 'seek'):
+        file_path.seek(0)
+
+
+def parse_excel_streaming(file_path, category_map=None):
+    """Lê a planilha em uma única passada (openpyxl em modo somente leitura)."""
+    from openpyxl import load_workbook
+
+    category_map = category_map or DEFAULT_CATEGORY_MAP
+    phases = metrics.PhaseTimer(PARSE_PHASE_METRIC, parser='streaming')
+    _rewind(file_path)
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        rows = workbook[SHEET_NAME].iter_rows(values_only=True)
+
+        first_row = next(rows, None)
+        if not first_row:
+            raise ValueError("Planilha vazia.")
+        month = _month_from_header(first_row[0])
+
+        header_row = next(rows, None) or ()
+        header = list(header_row)
+        if 'Descrição' not in header or 'Total' not in header:
+            # Layout diferente do esperado: o caminho com pandas resolve a coluna de valores
+            raise LookupError("Colunas 'Descrição'/'Total' não encontradas no cabeçalho.")
+        desc_idx = header.index('Descrição')
+        total_idx = header.index('Total')
+
+        totals_cells = {}
+        _match_totals_label(first_row, totals_cells)
+        _match_totals_label(header_row, totals_cells)
+        details = []
+        for row in rows:
+            _match_totals_label(row, totals_cells)
+            description = row[desc_idx] if len(row) > desc_idx else None
+            if description is None:
+                continue
+            details.append((str(description), row[total_idx] if len(row) > total_idx else None))
+    finally:
+        workbook.close()
+    phases.lap('read')
+
+    if 'Receitas:' not in totals_cells or 'Despesas:' not in totals_cells:
+        raise ValueError("Não foi possível encontrar 'Receitas:' ou 'Despesas:' na coluna K do arquivo.")
+    total_revenue = convert_br_to_float(totals_cells['Receitas:'])
+    total_expenses_raw = convert_br_to_float(totals_cells['Despesas:'])
+    phases.lap('totals')
+
+    # Cálculo de Honorários
+    total_fees = math.fsum(convert_br_to_float(amount) for description, amount in details
+                           if _is_fee_description(description))
+    phases.lap('fees')
+
+    # Categorização: um acesso ao dicionário por linha, agrupando na ordem das categorias
+    grouped = {category: [] for category in category_map.values()}
+    unmapped = []
+    for description, raw_amount in details:
+        amount = convert_br_to_float(raw_amount)
+        if amount == 0:
+            continue
+        stripped = description.strip()
+        category = category_map.get(stripped)
+        if category is not None:
+            grouped[category].append((month, category, description, float(amount)))
+        elif stripped and not _is_fee_description(stripped):
+            unmapped.append((stripped, amount))
+    expenses_data = [expense for expenses in grouped.values() for expense in expenses]
+    phases.lap('categorization')
+
+    totals_data = _build_totals_data(month, total_revenue, total_expenses_raw, total_fees)
+    return _build_result(month, totals_data, expenses_data, _summarize_unmapped(unmapped))
+
+
+def parse_excel_pandas(file_path, category_map=None):
+    """Caminho original com pandas: lê a planilha três vezes (cabeçalho, totais e detalhes)."""
+    import pandas as pd
+
+    category_map = category_map or DEFAULT_CATEGORY_MAP
+    phases = metrics.PhaseTimer(PARSE_PHASE_METRIC, parser='pandas')
+    try:
+        # Lê o cabeçalho para extrair o mês
+        _rewind(file_path)
+        df_header = pd.read_excel(file_path, sheet_name=SHEET_NAME, nrows=1, header=None)
+        month = _month_from_header(df_header.iloc[0, 0])
+
+        # Lê o Excel SEM pular linhas
+        _rewind(file_path)
+        df = pd.read_excel(file_path, sheet_name=SHEET_NAME, header=None)
+        phases.lap('read')
+
+        # Procura por "Receitas:" e "Despesas:" na coluna 10 (índice 10)
+        coluna_busca = df.iloc[:, LABEL_COLUMN].astype(str).str.strip()
+        idx_receitas = coluna_busca[coluna_busca == 'Receitas:'].index
+        idx_despesas = coluna_busca[coluna_busca == 'Despesas:'].index
+
+        if len(idx_receitas) == 0 or len(idx_despesas) == 0:
+            raise ValueError("Não foi possível encontrar 'Receitas:' ou 'Despesas:' na coluna K do arquivo.")
+
+        # Pega a primeira ocorrência (caso haja mais de uma) na coluna L
+        total_revenue = convert_br_to_float(df.iloc[idx_receitas[0], VALUE_COLUMN])
+        total_expenses_raw = convert_br_to_float(df.iloc[idx_despesas[0], VALUE_COLUMN])
+        phases.lap('totals')
+
+        # Agora lê novamente COM cabeçalho para processar despesas detalhadas
+        _rewind(file_path)
+        df_with_header = pd.read_excel(file_path, sheet_name=SHEET_NAME, skiprows=1)
+        df_with_header['Descrição'] = df_with_header['Descrição'].astype(str)
+
+        # Encontra a coluna 'Total' para processar despesas detalhadas
+        if 'Total' in df_with_header.columns:
+            total_col = 'Total'
+        else:
+            numeric_cols = df_with_header.select_dtypes(include=['number']).columns
+            total_col = numeric_cols[-1] if len(numeric_cols) > 0 else df_with_header.columns[-1]
+        phases.lap('read')
+
+    except Exception as e:
+        raise ValueError(f"Erro ao ler os totais de Receita/Despesa do Excel. Detalhe: {e}")
+
+    descriptions = df_with_header['Descrição']
+    stripped = descriptions.str.strip()
+    amounts = convert_br_series(df_with_header[total_col])
+
+    # Cálculo de Honorários
+    desc_normalized = stripped.str.lower().str.normalize('NFKD').str.encode('ascii', errors='ignore').str.decode('utf-8')
+    mask_honorarios = desc_normalized.str.startswith('honorario', na=False)
+    total_fees = float(amounts[mask_honorarios].sum())
+    phases.lap('fees')
+
+    # Categorização vetorizada: mapeia todas as descrições de uma vez e ordena
+    # (de forma estável) pela ordem das categorias
+    category_order = {category: position for position, category in enumerate(dict.fromkeys(category_map.values()))}
+    categories = stripped.map(category_map)
+    mapped = categories.notna() & (amounts != 0)
+    selected = pd.DataFrame({
+        'category': categories[mapped],
+        'description': descriptions[mapped],
+        'amount': amounts[mapped],
+    })
+    selected = selected.iloc[selected['category'].map(category_order).argsort(kind='stable')]
+    expenses_data = [(month, category, description, float(amount))
+                     for category, description, amount in selected.itertuples(index=False)]
+
+    unmapped_mask = (categories.isna() & (amounts != 0) & ~mask_honorarios
+                     & (stripped != '') & (stripped != 'nan'))
+    unmapped = list(zip(stripped[unmapped_mask], amounts[unmapped_mask]))
+    phases.lap('categorization')
+
+    totals_data = _build_totals_data(month, total_revenue, total_expenses_raw, total_fees)
+    return _build_result(month, totals_data, expenses_data, _summarize_unmapped(unmapped))
+
+
+def parse_excel(file_path, category_map=None):
+    """Processa o relatório mensal; usa o leitor em passada única e recorre ao pandas se falhar.
+
+    `file_path` pode ser um caminho ou um arquivo binário aberto (ex.: BytesIO).
+    `category_map` ({subcategoria: categoria}, normalmente vindo da tabela
+    `categories`) define a categorização; sem ele, usa CATEGORIES.
+    """
+    try:
+        return parse_excel_streaming(file_path, category_map)
+    except Exception as e:
+        logger.info("Leitura em passada única falhou (%s); usando pandas.", e)
+        return parse_excel_pandas(file_path, category_map)
+
+
+def _same_result(first, second):
+    """Compara dois resultados tolerando diferenças de arredondamento nas somas."""
+    if first['expenses_data'] != second['expenses_data'] or first['month'] != second['month']:
+        return False
+    if [(item['subcategory'], item['count']) for item in first['unmapped']] != \
+            [(item['subcategory'], item['count']) for item in second['unmapped']]:
+        return False
+    return all(
+        value == second['totals_data'][key] if isinstance(value, str)
+        else math.isclose(value, second['totals_data'][key], abs_tol=0.005)
+        for key, value in first['totals_data'].items()
+    )
+
+
+def compare_parse_times(file_path, repeat=5):
+    """Mede o tempo de leitura dos dois caminhos e confere se produzem o mesmo resultado."""
+    timings = {}
+    results = {}
+    for name, parser in (('streaming', parse_excel_streaming), ('pandas', parse_excel_pandas)):
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            results[name] = parser(file_path)
+            samples.append(time.perf_counter() - start)
+        timings[name] = {'min': min(samples), 'mean': sum(samples) / len(samples)}
+    timings['speedup'] = timings['pandas']['min'] / timings['streaming']['min']
+    timings['same_result'] = _same_result(results['streaming'], results['pandas'])
+    return timings
+
+
+if __name__ == '__main__':
+    import json
+    import sys
+
+    if len(sys.argv) < 2:
+        sys.exit("Uso: python excel_parser.py <relatorio.xlsx> [repetições]")
+    print(json.dumps(compare_parse_times(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 5), indent=2))
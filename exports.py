@@ -0,0 +1,139 @@
+"""Geradores de exportação (CSV, Parquet e Arrow) alimentados por database.iter_export_batches.
+
+Cada gerador devolve pedaços de bytes conforme os lotes são lidos do banco, para
+serem enviados em uma resposta em streaming: a memória usada depende do
+tamanho do lote, não do período exportado. Parquet e Arrow dependem do pyarrow
+(requirements.txt), importado só quando um desses formatos é pedido.
+"""
+import contextvars
+import csv
+import io
+
+import database as db
+
+FORMATS = {
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.file', 'arrow'),
+}
+
+# Tipos do pyarrow para os tipos declarados em database.EXPORT_COLUMNS
+_ARROW_TYPES = {'text': 'string', 'real': 'float64', 'integer': 'int64'}
+
+
+class ExportUnavailable(Exception):
+    """Formato de exportação que depende de uma biblioteca não instalada."""
+
+
+def _load_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ExportUnavailable("Exportação em Parquet/Arrow requer o pacote 'pyarrow' (pip install pyarrow).")
+    return pyarrow
+
+
+class _ChunkSink(io.RawIOBase):
+    """Destino de escrita que acumula os bytes até serem recolhidos com drain()."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_csv(table, start_month=None, end_month=None):
+    """CSV com cabeçalho; o BOM faz o Excel reconhecer o UTF-8 (acentos)."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(name for name, _ in db.EXPORT_COLUMNS[table])
+    yield '\ufeff'.encode('utf-8') + buffer.getvalue().encode('utf-8')
+    for rows in db.iter_export_batches(table, start_month, end_month):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+
+
+def _arrow_schema(pa, table):
+    return pa.schema([(name, getattr(pa, _ARROW_TYPES[kind])()) for name, kind in db.EXPORT_COLUMNS[table]])
+
+
+def _record_batch(pa, schema, rows):
+    columns = list(zip(*rows))
+    return pa.record_batch([pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+                           schema=schema)
+
+
+def iter_parquet(table, start_month=None, end_month=None):
+    """Parquet com um row group por lote lido do banco."""
+    pa = _load_pyarrow()
+    schema = _arrow_schema(pa, table)
+    sink = _ChunkSink()
+    writer = pa.parquet.ParquetWriter(sink, schema, compression='zstd')
+    try:
+        for rows in db.iter_export_batches(table, start_month, end_month):
+            writer.write_batch(_record_batch(pa, schema, rows), row_group_size=len(rows))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def iter_arrow(table, start_month=None, end_month=None):
+    """Arquivo Arrow IPC (Feather v2) com um record batch por lote lido do banco."""
+    pa = _load_pyarrow()
+    schema = _arrow_schema(pa, table)
+    sink = _ChunkSink()
+    writer = pa.ipc.new_file(sink, schema)
+    try:
+        for rows in db.iter_export_batches(table, start_month, end_month):
+            writer.write_batch(_record_batch(pa, schema, rows))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+GENERATORS = {'csv': iter_csv, 'parquet': iter_parquet, 'arrow': iter_arrow}
+
+
+def export_stream(table, fmt, start_month=None, end_month=None):
+    """Gerador de bytes da exportação; levanta ExportUnavailable antes do primeiro byte."""
+    stream = GENERATORS[fmt](table, start_month, end_month)
+    # O servidor consome a resposta depois que a requisição retorna: cada pedaço é
+    # gerado no contexto copiado aqui, para ler do banco do escritório da requisição
+    context = contextvars.copy_context()
+    # Roda até o primeiro pedaço já aqui, para que a falta do pyarrow vire uma
+    # mensagem de erro e não uma resposta 200 interrompida
+    first = context.run(next, stream)
+
+    def chained():
+        try:
+            yield first
+            while True:
+                chunk = context.run(next, stream, None)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            stream.close()  # fecha a conexão da exportação se o cliente desistir no meio
+    return chained()
@@ -0,0 +1,303 @@
+"""Métricas no formato texto do Prometheus, agregadas entre processos.
+
+Cada processo (worker do gunicorn, processo do lote de importação) acumula
+contadores e histogramas em memória e grava periodicamente um arquivo
+METRICS_DIR/metrics-<pid>.json. O /metrics soma os arquivos de todos os
+processos. Arquivos de processos que já terminaram são absorvidos pelo
+processo que gera o /metrics, para que os contadores não voltem atrás nem o
+diretório cresça sem limite.
+"""
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'contajur-metrics'))
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))  # segundos
+
+# Limites (em segundos) dos buckets dos histogramas de duração
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# nome -> (tipo, descrição)
+METRICS = {
+    'contajur_http_requests_total': ('counter', 'Requisições HTTP por rota, método e status.'),
+    'contajur_http_request_duration_seconds': ('histogram', 'Duração das requisições HTTP.'),
+    'contajur_template_render_duration_seconds': ('histogram', 'Duração da renderização dos templates Jinja.'),
+    'contajur_db_statement_duration_seconds': ('histogram', 'Duração dos comandos SQL (execução e leitura das linhas).'),
+    'contajur_db_rows_total': ('counter', 'Linhas lidas ou alteradas pelos comandos SQL.'),
+    'contajur_parse_phase_duration_seconds': ('histogram', 'Duração das fases da leitura das planilhas.'),
+    'contajur_result_cache_hits_total': ('counter', 'Acertos do cache de resultados.'),
+    'contajur_result_cache_misses_total': ('counter', 'Faltas do cache de resultados.'),
+    'contajur_result_cache_evictions_total': ('counter', 'Entradas descartadas do cache de resultados.'),
+    'contajur_result_cache_entries': ('gauge', 'Entradas no cache de resultados.'),
+    'contajur_db_pool_opened_total': ('counter', 'Conexões SQLite abertas pelo pool.'),
+    'contajur_db_pool_reused_total': ('counter', 'Conexões SQLite reaproveitadas do pool.'),
+    'contajur_db_pool_evictions_total': ('counter', 'Conexões ociosas fechadas por exceder o limite do pool.'),
+    'contajur_db_pool_idle_connections': ('gauge', 'Conexões SQLite ociosas no pool.'),
+    'contajur_db_pool_in_use_connections': ('gauge', 'Conexões SQLite em uso.'),
+}
+
+
+class _Registry:
+    """Valores do processo atual; descartados se o processo for clonado (fork)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.collectors = []
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self.absorbed = {'counters': {}, 'histograms': {}}
+        self.last_flush = 0.0
+
+    def check_pid(self):
+        # Um processo filho herda os valores do pai; sem isso eles seriam contados duas vezes
+        if self.pid != os.getpid():
+            self._reset()
+
+
+_registry = _Registry()
+
+
+def _after_fork_in_child():
+    # O fork pode acontecer com a trava tomada por outra thread do pai, que não
+    # existe no filho: uma trava nova evita que o filho espere por ela para sempre
+    _registry.lock = threading.Lock()
+    _registry._reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def inc(name, value=1, **labels):
+    """Soma `value` ao contador `name` com os rótulos informados."""
+    with _registry.lock:
+        _registry.check_pid()
+        _registry.counters[_key(name, labels)] += value
+    _maybe_flush()
+
+
+def observe(name, seconds, **labels):
+    """Registra uma observação no histograma `name`."""
+    with _registry.lock:
+        _registry.check_pid()
+        histogram = _registry.histograms.get(_key(name, labels))
+        if histogram is None:
+            histogram = _registry.histograms[_key(name, labels)] = [[0] * len(DURATION_BUCKETS), 0.0, 0]
+        for position, bound in enumerate(DURATION_BUCKETS):
+            if seconds <= bound:
+                histogram[0][position] += 1
+                break
+        histogram[1] += seconds
+        histogram[2] += 1
+    _maybe_flush()
+
+
+class PhaseTimer:
+    """Mede fases consecutivas: cada lap(fase) registra o tempo desde a marca anterior."""
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self.last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        observe(self.name, now - self.last, phase=phase, **self.labels)
+        self.last = now
+
+
+def register_collector(collect):
+    """Registra uma função que devolve [(nome, rótulos, valor)] lida a cada gravação.
+
+    Serve para valores que já são acumulados em outro lugar (ex.: estatísticas do cache).
+    Os declarados como 'counter' em METRICS são gravados com os contadores, e
+    por isso absorvidos quando o processo termina; os demais, como gauges.
+    """
+    _registry.collectors.append(collect)
+
+
+def _snapshot():
+    """Valores do processo (incluindo os absorvidos) no formato gravado em disco."""
+    counters = dict(_registry.absorbed['counters'])
+    for (name, labels), value in _registry.counters.items():
+        key = json.dumps([name, labels])
+        counters[key] = counters.get(key, 0) + value
+    histograms = {key: [list(buckets), total, count]
+                  for key, (buckets, total, count) in _registry.absorbed['histograms'].items()}
+    for (name, labels), (buckets, total, count) in _registry.histograms.items():
+        _merge_histogram(histograms, json.dumps([name, labels]), [buckets, total, count])
+    gauges = {}
+    for collect in _registry.collectors:
+        for name, labels, value in collect():
+            key = json.dumps([name, sorted(labels.items())])
+            if METRICS.get(name, ('gauge',))[0] == 'counter':
+                counters[key] = counters.get(key, 0) + value
+            else:
+                gauges[key] = value
+    return {'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+
+def _merge_histogram(histograms, key, values):
+    buckets, total, count = values
+    current = histograms.get(key)
+    if current is None:
+        histograms[key] = [list(buckets), total, count]
+    else:
+        current[0] = [a + b for a, b in zip(current[0], buckets)]
+        current[1] += total
+        current[2] += count
+
+
+def _path(pid):
+    return os.path.join(METRICS_DIR, f'metrics-{pid}.json')
+
+
+def flush():
+    """Grava os valores do processo atual (escrita atômica)."""
+    with _registry.lock:
+        _registry.check_pid()
+        snapshot = _snapshot()
+        _registry.last_flush = time.monotonic()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = _path(_registry.pid)
+    temp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as handle:
+        json.dump(snapshot, handle)
+    os.replace(temp_path, path)
+
+
+def _maybe_flush():
+    if time.monotonic() - _registry.last_flush >= METRICS_FLUSH_INTERVAL:
+        try:
+            flush()
+        except OSError:
+            pass  # Métricas nunca devem derrubar uma requisição
+
+
+def _flush_at_exit():
+    try:
+        flush()
+    except OSError:
+        pass
+
+
+atexit.register(_flush_at_exit)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _absorb_dead_processes():
+    """Incorpora aos valores deste processo os arquivos de processos que já terminaram."""
+    # os.kill(pid, 0) só é uma consulta em POSIX; no Windows ele encerraria o processo
+    if os.name != 'posix':
+        return
+    for filename in os.listdir(METRICS_DIR):
+        if not (filename.startswith('metrics-') and filename.endswith('.json')):
+            continue
+        pid = int(filename[len('metrics-'):-len('.json')])
+        if pid == os.getpid() or _pid_alive(pid):
+            continue
+        # O rename é atômico: só um processo consegue reivindicar o arquivo
+        claimed = os.path.join(METRICS_DIR, f'{filename}.claimed-{os.getpid()}')
+        try:
+            os.rename(os.path.join(METRICS_DIR, filename), claimed)
+        except FileNotFoundError:
+            continue
+        try:
+            with open(claimed, encoding='utf-8') as handle:
+                data = json.load(handle)
+        except ValueError:
+            data = {}
+        with _registry.lock:
+            _registry.check_pid()
+            absorbed = _registry.absorbed
+            for key, value in data.get('counters', {}).items():
+                absorbed['counters'][key] = absorbed['counters'].get(key, 0) + value
+            for key, values in data.get('histograms', {}).items():
+                _merge_histogram(absorbed['histograms'], key, values)
+        os.remove(claimed)
+
+
+def collect():
+    """Soma os arquivos de todos os processos: (contadores, histogramas, gauges)."""
+    flush()
+    _absorb_dead_processes()
+    flush()
+    counters = defaultdict(float)
+    histograms = {}
+    gauges = defaultdict(float)
+    for filename in os.listdir(METRICS_DIR):
+        if not (filename.startswith('metrics-') and filename.endswith('.json')):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, filename), encoding='utf-8') as handle:
+                data = json.load(handle)
+        except (OSError, ValueError):
+            continue  # Processo encerrado ou arquivo absorvido durante a leitura
+        for key, value in data['counters'].items():
+            counters[key] += value
+        for key, values in data['histograms'].items():
+            _merge_histogram(histograms, key, values)
+        for key, value in data['gauges'].items():
+            gauges[key] += value
+    return counters, histograms, gauges
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def render():
+    """Texto no formato de exposição do Prometheus (version 0.0.4)."""
+    counters, histograms, gauges = collect()
+    by_name = defaultdict(list)
+    for source in (counters, gauges):
+        for key, value in source.items():
+            name, labels = json.loads(key)
+            by_name[name].append((labels, value))
+    for key, values in histograms.items():
+        name, labels = json.loads(key)
+        by_name[name].append((labels, values))
+
+    lines = []
+    for name in sorted(by_name):
+        kind, description = METRICS.get(name, ('untyped', ''))
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in sorted(by_name[name], key=lambda item: item[0]):
+            if kind != 'histogram':
+                lines.append(f'{name}{_format_labels(labels)} {value:g}')
+                continue
+            buckets, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(DURATION_BUCKETS, buckets):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", f"{bound:g}")])} {cumulative}')
+            lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {count}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {total:g}')
+            lines.append(f'{name}_count{_format_labels(labels)} {count}')
+    return '\n'.join(lines) + '\n'
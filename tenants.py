@@ -0,0 +1,55 @@
+"""Roteamento de escritórios (tenants): cada requisição é atendida com o banco do escritório.
+
+O escritório vem do subdomínio (escritorio.TENANT_DOMAIN) ou do prefixo
+/t/<escritorio> na URL. O prefixo é movido para SCRIPT_NAME, então as rotas do
+Flask não mudam e url_for já gera os links com o prefixo. Sem TENANT_DATA_DIR
+(ver database.py) o middleware não faz nada.
+"""
+import os
+
+from werkzeug.exceptions import NotFound
+
+import database as db
+
+TENANT_PREFIX = '/t/'
+# Domínio base para o roteamento por subdomínio (ex.: contajur.com.br); vazio desliga
+TENANT_DOMAIN = os.environ.get('TENANT_DOMAIN', '').lower().strip('.')
+
+
+def tenant_from_host(host):
+    """Escritório do subdomínio de TENANT_DOMAIN, ou None."""
+    host = (host or '').lower().rsplit(':', 1)[0]
+    if not TENANT_DOMAIN or not host.endswith('.' + TENANT_DOMAIN):
+        return None
+    subdomain = host[:-len(TENANT_DOMAIN) - 1]
+    return None if subdomain == 'www' else subdomain
+
+
+class TenantMiddleware:
+    """Middleware WSGI que define database.current_tenant durante a requisição.
+
+    Respostas em streaming continuam depois que o app retorna: os geradores
+    precisam rodar em uma cópia do contexto da requisição (ver exports.export_stream).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        if not db.TENANT_DATA_DIR:
+            return self.app(environ, start_response)
+
+        tenant = tenant_from_host(environ.get('HTTP_HOST'))
+        path = environ.get('PATH_INFO', '')
+        if tenant is None and path.startswith(TENANT_PREFIX):
+            tenant, _, rest = path[len(TENANT_PREFIX):].partition('/')
+            environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + TENANT_PREFIX + tenant
+            environ['PATH_INFO'] = '/' + rest
+        if tenant is not None and not db.tenant_exists(tenant):
+            return NotFound(f"Escritório não encontrado: {tenant}")(environ, start_response)
+
+        token = db.current_tenant.set(tenant)
+        try:
+            return self.app(environ, start_response)
+        finally:
+            db.current_tenant.reset(token)